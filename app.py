@@ -4,47 +4,578 @@ Persistent PDF annotator with reconnect-safe student tokens and teacher key.
 Added endpoints:
  - clear_my_annotations (student): removes strokes authored by that student
  - clear_teacher_annotations (teacher): removes strokes authored by teacher
+ - undo_stroke / redo_stroke: take back / put back the sender's own latest strokes
+Each class lives in state/<class_id>.json (snapshot) plus
+state/<class_id>.journal (append-only log of mutations since the snapshot).
+Classes are loaded on first join and dropped from memory when idle.
 Run:
     pip install aiohttp
+    pip install orjson    # optional, faster JSON encoding
+    pip install pymupdf pillow    # optional, for RASTER_PAGES=1 (pillow adds WebP)
     python app.py
+    RASTER_PAGES=1 python app.py    # also serve pages as images for slow devices
+    WORKERS=4 python app.py    # one process per core, classes spread across them
+    WORKERS=4 ROUTING=affinity python app.py    # same, each class's sockets piped to its owner
 """
+import asyncio
+import base64
+import binascii
+import gzip
+import hashlib
 import json
+import multiprocessing
 import os
+import re
 import secrets
+import shutil
 import string
+import struct
+import sys
+import time
 import uuid
-from aiohttp import web, WSMsgType
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from aiohttp import web, WSMsgType, WSCloseCode, ClientError, ClientSession, UnixConnector
+
+try:
+    import orjson  # optional, several times faster than the stdlib encoder
+except ImportError:
+    orjson = None
+
+try:
+    import numpy  # optional, speeds up simplifying long strokes
+except ImportError:
+    numpy = None
+
+try:
+    import pymupdf  # optional, only for RASTER_PAGES=1
+except ImportError:
+    pymupdf = None
+
+try:
+    from PIL import Image  # optional, WebP page images instead of PNG
+except ImportError:
+    Image = None
+
+try:
+    import redis.asyncio as aioredis  # optional, only for BACKPLANE=redis://...
+except ImportError:
+    aioredis = None
 
 BASE_DIR = os.path.dirname(__file__)
 UPLOAD_DIR = os.path.join(BASE_DIR, "uploads")
-STATE_FILE = os.path.join(BASE_DIR, "state.json")
+# one snapshot (<class_id>.json) and one journal (<class_id>.journal) per class
+STATE_DIR = os.path.join(BASE_DIR, "state")
+# pre-sharding single-file state, split into STATE_DIR on first start
+LEGACY_STATE_FILE = os.path.join(BASE_DIR, "state.json")
+LEGACY_JOURNAL_FILE = os.path.join(BASE_DIR, "state.journal")
+# fold a class journal back into its snapshot once it holds this many records
+JOURNAL_COMPACT_RECORDS = int(os.environ.get("JOURNAL_COMPACT_RECORDS", "1000"))
+# seconds of mutations coalesced into one background journal write
+PERSIST_DELAY = float(os.environ.get("PERSIST_DELAY", "0.25"))
+# seconds a class with nobody connected stays in memory
+ROOM_IDLE_TIMEOUT = float(os.environ.get("ROOM_IDLE_TIMEOUT", "600"))
+ROOM_SWEEP_INTERVAL = 60
+# frames queued per connection before the slow-consumer policy kicks in
+OUTBOX_MAX = int(os.environ.get("OUTBOX_MAX", "256"))
+# overflows tolerated (without the queue draining in between) before a slow client is disconnected
+SLOW_CLIENT_OVERFLOWS = int(os.environ.get("SLOW_CLIENT_OVERFLOWS", "3"))
+# max distance (in page-normalized units) a simplified stroke may stray from the drawn one; 0 disables
+SIMPLIFY_TOLERANCE = float(os.environ.get("SIMPLIFY_TOLERANCE", "0.0005"))
+# points simplified together; longer strokes are split into windows this long
+SIMPLIFY_WINDOW = 256
+# spans longer than this are searched with NumPy (when installed); below it the array round-trip costs more
+SIMPLIFY_NUMPY_SPAN = 64
+# strokes each author can undo (and then redo) in a row
+UNDO_HISTORY = int(os.environ.get("UNDO_HISTORY", "50"))
+# stroke changes per class kept in memory for clients rejoining with last_seq
+RESUME_DELTAS = int(os.environ.get("RESUME_DELTAS", "512"))
+# Per-connection limits, as token buckets holding RATE_BURST seconds' worth:
+# messages per second and stroke points per second; beyond them messages are dropped
+MSG_RATE = float(os.environ.get("MSG_RATE", "200"))
+POINT_RATE = float(os.environ.get("POINT_RATE", "5000"))
+RATE_BURST = float(os.environ.get("RATE_BURST", "2"))
+# points one stroke may have (one "stroke" message, or all the deltas of a streamed one)
+MAX_STROKE_POINTS = int(os.environ.get("MAX_STROKE_POINTS", "4000"))
+# Per-class broadcast tick in seconds: new strokes are held until the tick and "batch"
+# clients get all of them in one apply_strokes; about one display frame (16-33 ms)
+BROADCAST_TICK = float(os.environ.get("BROADCAST_TICK_MS", "16")) / 1000
+# seconds joins and leaves are gathered before a class is told, so a join storm costs one frame per window
+PRESENCE_DEBOUNCE = float(os.environ.get("PRESENCE_DEBOUNCE_MS", "250")) / 1000
+# largest PDF /upload accepts, in bytes; uploads are streamed to disk in UPLOAD_CHUNK pieces
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_CHUNK = 256 * 1024
+# also store a gzip copy of each new PDF when it saves at least 10%; served to clients that accept it,
+# but PDF.js cannot range-request a compressed response, so this suits small or unlinearized files
+PRECOMPRESS_PDFS = os.environ.get("PRECOMPRESS_PDFS", "") == "1"
+# Serve pages as images rendered on the server (/pages/...), for devices too slow for PDF.js.
+# Each page is rendered at the smallest of RASTER_WIDTHS (pixels) covering the requested
+# width, in RASTER_PROCESSES processes, and cached under uploads/pages/<doc>/.
+RASTER_PAGES = os.environ.get("RASTER_PAGES", "") == "1"
+RASTER_WIDTHS = tuple(sorted(int(w) for w in os.environ.get("RASTER_WIDTHS", "480,960,1440").split(",")))
+RASTER_PROCESSES = int(os.environ.get("RASTER_PROCESSES", "2"))
+# TCP port to listen on (every worker shares it)
+PORT = int(os.environ.get("PORT", "8080"))
+# Server processes sharing the load, and which one this is. Each class is owned
+# by one worker (see class_owner); the others relay its sockets over BACKPLANE:
+#   ""                 everything in this process (WORKERS=1)
+#   unix:<path>        the hub that `WORKERS=n python app.py` starts for its n workers
+#   redis://host:port  Redis pub/sub (or a compatible server), for workers on several hosts
+#                      sharing uploads/ and state/; start each with its own WORKER_ID
+WORKERS = int(os.environ.get("WORKERS", "1"))
+WORKER_ID = int(os.environ.get("WORKER_ID", "0"))
+BACKPLANE = os.environ.get("BACKPLANE", "")
+# seconds between attempts to reconnect a broken backplane, at most (starting at 0.1 and doubling)
+BACKPLANE_RETRY_MAX = 5
+# How a socket that landed on the wrong worker reaches its class:
+#   backplane  its messages and frames are relayed over BACKPLANE (above)
+#   affinity   the whole connection is piped to the owner's own Unix socket
+#              (worker-<n>.sock in STATE_DIR), so a class's sockets are all local to
+#              its owner and broadcasts never leave the process; workers must share a host
+ROUTING = os.environ.get("ROUTING", "backplane")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# Persistent classes state
+# Loaded classes (a subset of those on disk); keys starting with "_" are runtime-only
 classes = {}
 # Transient clients map
 clients = {}
+# class_id -> {client_id: info} in join order, and the same keyed by (class_id, token) for one student/teacher
+class_clients = {}
+token_clients = {}
+# class_id -> encoded journal lines waiting for the persistence worker
+pending_lines = {}
+# class_id -> future of a load in progress, so concurrent joins share one disk read
+loading_rooms = {}
+metrics = {"frames_sent": 0, "frames_dropped": 0, "resyncs": 0, "slow_disconnects": 0,
+           "stroke_points_in": 0, "stroke_points_kept": 0, "resumes": 0, "resume_misses": 0,
+           "backplane_out": 0, "backplane_in": 0, "backplane_dropped": 0, "affinity_relays": 0, "pdf_dedups": 0,
+           "rate_limited": 0, "strokes_too_large": 0, "stroke_batches": 0, "stroke_batch_strokes": 0}
+persist_wakeup = asyncio.Event()
+persist_lock = asyncio.Lock()
+# one thread, so journal appends and snapshots hit the disk in submission order
+persist_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+
+# room fields persisted by a "meta" journal record (everything except strokes)
+META_KEYS = ("teacher_key", "pdf_filename", "pdf_sha256", "students", "pending", "last_student_annotator", "current_annotator")
+CLASS_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# aiohttp >= 3.11 (as pinned) writes pre-encoded bytes as a text frame; older releases re-encode per recipient
+SEND_FRAME = hasattr(web.WebSocketResponse, "send_frame")
+
+# ---------------- JSON ----------------
+def encode(payload):
+    """Compact UTF-8 JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    # escaped: json.loads accepts lone surrogates (orjson.loads does not), and they cannot be encoded raw
+    return json.dumps(payload, separators=(",", ":")).encode("ascii")
+
+def decode(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# ---------------- Stroke encoding ----------------
+# Strokes are stored, journaled and sent to "q16" clients with their points
+# packed into one string, "p", instead of a list of {"x", "y"} floats:
+# each normalized coordinate is quantized to uint16, delta-encoded against
+# the previous point (wrapping to int16), zigzag-mapped and written as a
+# LEB128 varint, x before y; the bytes are base64-encoded. A typical
+# pen point costs 2-4 bytes instead of ~40.
+Q16_SCALE = 65535
+
+def quantize(v):
+    try:
+        return min(Q16_SCALE, max(0, int(round(float(v) * Q16_SCALE))))
+    except (TypeError, ValueError):
+        return 0
+
+def pack_points(points):
+    out = bytearray()
+    px = py = 0
+    for pt in points:
+        if not isinstance(pt, dict):
+            continue
+        x = quantize(pt.get("x"))
+        y = quantize(pt.get("y"))
+        for d in (x - px, y - py):
+            d = ((d + 0x8000) & 0xFFFF) - 0x8000
+            z = (d << 1) if d >= 0 else ((-d << 1) - 1)
+            while z >= 0x80:
+                out.append((z & 0x7F) | 0x80)
+                z >>= 7
+            out.append(z)
+        px, py = x, y
+    return base64.b64encode(bytes(out)).decode("ascii")
+
+def unpack_points(packed):
+    """Inverse of pack_points; raises ValueError on malformed input."""
+    try:
+        raw = base64.b64decode(packed, validate=True)
+    except (binascii.Error, TypeError) as e:
+        raise ValueError("bad packed points") from e
+    values = []
+    z = shift = 0
+    for b in raw:
+        z |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+            continue
+        values.append((z >> 1) if not z & 1 else -((z + 1) >> 1))
+        z = shift = 0
+    if shift or len(values) % 2:
+        raise ValueError("truncated packed points")
+    points = []
+    x = y = 0
+    for i in range(0, len(values), 2):
+        x = (x + values[i]) & 0xFFFF
+        y = (y + values[i + 1]) & 0xFFFF
+        points.append({"x": round(x / Q16_SCALE, 5), "y": round(y / Q16_SCALE, 5)})
+    return points
+
+def pack_stroke(entry):
+    """Stored form of a stroke: "points" replaced by packed "p"."""
+    if "points" not in entry:
+        return entry
+    packed = {k: v for k, v in entry.items() if k != "points"}
+    packed["p"] = pack_points(entry["points"] or [])
+    return packed
+
+def convert_strokes(obj, codec):
+    """Copy of obj with every stroke's points in the codec's form: packed "p" for q16, "points" for json."""
+    if isinstance(obj, list):
+        return [convert_strokes(o, codec) for o in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for k, v in obj.items():
+        if k == "points":
+            if codec == "q16":
+                out["p"] = pack_points(v)
+            else:
+                out[k] = v
+        elif k == "p":
+            if codec == "q16":
+                out[k] = v
+            else:
+                out["points"] = unpack_points(v)
+        elif isinstance(v, (dict, list)):
+            out[k] = convert_strokes(v, codec)
+        else:
+            out[k] = v
+    return out
 
 # ---------------- Persistence helpers ----------------
+# state/<class_id>.json is a snapshot; every mutation after it is appended to
+# state/<class_id>.journal as one compact JSON line:
+#   {"op":"meta",   "class_id":..., "meta": {...room fields except strokes}}
+#   {"op":"stroke", "class_id":..., "page":..., "stroke": {..., "id": n}}
+#   {"op":"clear",  "class_id":..., "author": <author or null for all>}
+#   {"op":"remove", "class_id":..., "author":..., "ids": [...]}
+def snapshot_path(class_id):
+    return os.path.join(STATE_DIR, class_id + ".json")
+
+def journal_path(class_id):
+    return os.path.join(STATE_DIR, class_id + ".journal")
+
+# In memory a room keeps strokes as {page: {stroke_id: entry}} (insertion
+# ordered) plus "_by_author" {author: {stroke_id: page}}, so removing one
+# author's strokes touches only those. Snapshots and the wire use plain
+# {page: [entry, ...]} lists.
+#
+# Every stroke/clear/remove record advances the class "seq" by one, live and
+# on replay alike, so seq survives restarts without being journaled itself.
+def add_stroke(room, page, entry):
+    """Index a packed stroke entry, giving it the room's next id if it has none."""
+    stroke_id = entry.get("id")
+    if not isinstance(stroke_id, int):
+        stroke_id = entry["id"] = room["next_stroke_id"]
+    room["next_stroke_id"] = max(room["next_stroke_id"], stroke_id + 1)
+    room["strokes"].setdefault(page, {})[stroke_id] = entry
+    room["_by_author"].setdefault(entry.get("author"), {})[stroke_id] = page
+    return entry
+
+def remove_stroke(room, author, stroke_id):
+    """Drop one stroke by author; returns (page, entry), or None if it is not there."""
+    page = room["_by_author"].get(author, {}).pop(stroke_id, None)
+    if page is None:
+        return None
+    page_strokes = room["strokes"][page]
+    entry = page_strokes.pop(stroke_id)
+    if not page_strokes:
+        del room["strokes"][page]
+    return page, entry
+
+def remove_author_strokes(room, author):
+    """Drop every stroke by author (and their undo history); returns the removed ids."""
+    room["_undo"].pop(author, None)
+    room["_redo"].pop(author, None)
+    removed = room["_by_author"].pop(author, {})
+    for stroke_id, page in removed.items():
+        page_strokes = room["strokes"].get(page)
+        if page_strokes is not None:
+            page_strokes.pop(stroke_id, None)
+            if not page_strokes:
+                del room["strokes"][page]
+    return list(removed)
+
+def clear_strokes(room):
+    room["strokes"] = {}
+    room["_by_author"] = {}
+    # author -> deque of stroke ids to undo / (page, entry) to redo, newest last
+    room["_undo"] = {}
+    room["_redo"] = {}
+
+def hydrate_room(room):
+    """Turn a stored room (strokes as page lists) into its in-memory form."""
+    stored = room.get("strokes") or {}
+    room.setdefault("next_stroke_id", 1)
+    room.setdefault("seq", 0)
+    # the latest stroke changes as broadcast, oldest first (see push_delta)
+    room["_deltas"] = deque(maxlen=RESUME_DELTAS)
+    # apply_stroke deltas (with their recipient filter) waiting for flush_strokes
+    room["_held_strokes"] = []
+    room["_flush_handle"] = None
+    # client ids that joined or left since the last flush_presence (dicts as ordered sets)
+    room["_presence_joined"] = {}
+    room["_presence_left"] = {}
+    room["_presence_handle"] = None
+    clear_strokes(room)
+    for page, lst in stored.items():
+        for entry in lst:
+            # snapshots written before strokes were packed or had ids
+            add_stroke(room, page, pack_stroke(entry))
+    return room
+
+def stroke_pages(room):
+    """All strokes of a room as {page: [entry, ...]}."""
+    return {page: list(page_strokes.values()) for page, page_strokes in room["strokes"].items()}
+
+def apply_record(room, record):
+    op = record.get("op")
+    if op in ("stroke", "clear", "remove"):
+        room["seq"] += 1
+    if op == "meta":
+        room.update(record["meta"])
+    elif op == "stroke":
+        add_stroke(room, record["page"], pack_stroke(record["stroke"]))
+    elif op == "clear":
+        if record.get("author") is None:
+            clear_strokes(room)
+        else:
+            remove_author_strokes(room, record["author"])
+    elif op == "remove":
+        for stroke_id in record["ids"]:
+            remove_stroke(room, record["author"], stroke_id)
+
+def replay_journal(path, apply):
+    replayed = 0
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    apply(decode(line))
+                except Exception:
+                    # a torn final line from a crash mid-append; everything before it is intact
+                    print("Skipping bad journal record in", path)
+                    continue
+                replayed += 1
+    return replayed
+
+def class_exists(class_id):
+    if class_id in classes:
+        return True
+    if not CLASS_ID_RE.match(class_id):
+        return False
+    return os.path.exists(snapshot_path(class_id)) or os.path.exists(journal_path(class_id))
+
+def read_room(class_id):
+    """Rebuild one class from its snapshot plus journal (runs on persist_executor)."""
+    room = {}
+    if os.path.exists(snapshot_path(class_id)):
+        try:
+            with open(snapshot_path(class_id), "rb") as f:
+                room = decode(f.read())
+        except Exception as e:
+            print("Failed to load class", class_id, e)
+    hydrate_room(room)
+    room["_journal_records"] = replay_journal(journal_path(class_id), lambda rec: apply_record(room, rec))
+    return room
+
+async def get_room(class_id):
+    """Return a class, loading it from disk on first use; None if it does not exist."""
+    room = classes.get(class_id)
+    if room is not None:
+        return room
+    if not isinstance(class_id, str) or not class_exists(class_id):
+        return None
+    fut = loading_rooms.get(class_id)
+    if fut is None:
+        fut = asyncio.get_running_loop().run_in_executor(persist_executor, read_room, class_id)
+        loading_rooms[class_id] = fut
+        try:
+            room = await fut
+        finally:
+            loading_rooms.pop(class_id, None)
+        room["_last_active"] = time.monotonic()
+        classes[class_id] = room
+        return room
+    await fut
+    return classes.get(class_id)
+
 def load_state():
-    global classes
-    if os.path.exists(STATE_FILE):
+    """Prepare STATE_DIR, splitting a legacy state.json (+ state.journal) into per-class files once."""
+    if os.path.isdir(STATE_DIR):
+        return
+    os.makedirs(STATE_DIR + ".tmp", exist_ok=True)
+    legacy = {}
+    if os.path.exists(LEGACY_STATE_FILE):
         try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                classes = json.load(f)
+            with open(LEGACY_STATE_FILE, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
         except Exception as e:
             print("Failed to load state:", e)
-            classes = {}
-    else:
-        classes = {}
 
-def save_state():
+    for room in legacy.values():
+        hydrate_room(room)
+
+    def apply(record):
+        room = legacy.get(record["class_id"])
+        if room is None:
+            room = legacy[record["class_id"]] = hydrate_room({})
+        apply_record(room, record)
+    replay_journal(LEGACY_JOURNAL_FILE, apply)
+    for class_id, room in legacy.items():
+        if CLASS_ID_RE.match(class_id):
+            with open(os.path.join(STATE_DIR + ".tmp", class_id + ".json"), "wb") as f:
+                f.write(encode(copy_room(room)))
+    os.replace(STATE_DIR + ".tmp", STATE_DIR)
+
+def copy_room(room):
+    """Copy the persisted containers of a room so a thread can serialize them while the loop mutates the original.
+
+    Stroke entries are never modified once appended, so they are shared rather than copied.
+    """
+    copy = {k: room[k] for k in META_KEYS if k in room}
+    copy["strokes"] = stroke_pages(room)
+    copy["next_stroke_id"] = room["next_stroke_id"]
+    copy["seq"] = room["seq"]
+    copy["students"] = {token: dict(st) for token, st in room.get("students", {}).items()}
+    copy["pending"] = dict(room.get("pending", {}))
+    return copy
+
+def write_snapshot(class_id, snapshot):
+    """Write one class snapshot and truncate the journal it supersedes (runs on persist_executor)."""
+    path = snapshot_path(class_id)
+    try:
+        with open(path + ".tmp", "wb") as f:
+            f.write(encode(snapshot))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        open(journal_path(class_id), "w").close()
+    except Exception as e:
+        print("Failed to save class", class_id, e)
+
+def write_journal(class_id, lines):
+    """Append already-encoded journal lines and fsync once for the batch (runs on persist_executor)."""
     try:
-        with open(STATE_FILE + ".tmp", "w", encoding="utf-8") as f:
-            json.dump(classes, f, indent=2)
-        os.replace(STATE_FILE + ".tmp", STATE_FILE)
+        with open(journal_path(class_id), "ab") as f:
+            f.write(b"".join(lines))
+            f.flush()
+            os.fsync(f.fileno())
     except Exception as e:
-        print("Failed to save state:", e)
+        print("Failed to append journal for", class_id, e)
+
+def write_batch(batch):
+    for class_id, lines, snapshot in batch:
+        if lines:
+            write_journal(class_id, lines)
+        if snapshot is not None:
+            write_snapshot(class_id, snapshot)
+
+def journal_append(record):
+    pending_lines.setdefault(record["class_id"], []).append(encode(record) + b"\n")
+    persist_wakeup.set()
+
+def journal_meta(class_id):
+    room = classes[class_id]
+    journal_append({"op": "meta", "class_id": class_id, "meta": {k: room[k] for k in META_KEYS if k in room}})
+
+def journal_change(record):
+    classes[record["class_id"]]["seq"] += 1
+    journal_append(record)
+
+def journal_stroke(class_id, page, entry):
+    journal_change({"op": "stroke", "class_id": class_id, "page": page, "stroke": entry})
+
+def journal_clear(class_id, author=None):
+    journal_change({"op": "clear", "class_id": class_id, "author": author})
+
+def journal_remove(class_id, author, ids):
+    journal_change({"op": "remove", "class_id": class_id, "author": author, "ids": ids})
+
+async def flush_persistence(compact=()):
+    """Hand buffered journal lines of dirty classes (and their snapshots, when due) to the persistence thread.
+
+    Classes in compact get a snapshot as soon as their journal holds anything, the rest at JOURNAL_COMPACT_RECORDS.
+    """
+    global pending_lines
+    async with persist_lock:
+        dirty, pending_lines = pending_lines, {}
+        compact = set(compact)
+        batch = []
+        for class_id in set(dirty) | compact:
+            lines = dirty.get(class_id, [])
+            room = classes.get(class_id)
+            snapshot = None
+            if room is not None:
+                room["_journal_records"] = room.get("_journal_records", 0) + len(lines)
+                if room["_journal_records"] >= (1 if class_id in compact else JOURNAL_COMPACT_RECORDS):
+                    room["_journal_records"] = 0
+                    snapshot = copy_room(room)
+            if lines or snapshot is not None:
+                batch.append((class_id, lines, snapshot))
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(persist_executor, write_batch, batch)
+
+async def persistence_worker():
+    while True:
+        await persist_wakeup.wait()
+        # let a burst of strokes pile up so it costs one write and one fsync
+        await asyncio.sleep(PERSIST_DELAY)
+        persist_wakeup.clear()
+        await flush_persistence()
+
+def room_has_clients(class_id):
+    return bool(class_clients.get(class_id))
+
+async def evict_idle_rooms():
+    """Drop classes nobody has been connected to for ROOM_IDLE_TIMEOUT; they reload from disk on the next join."""
+    while True:
+        await asyncio.sleep(ROOM_SWEEP_INTERVAL)
+        now = time.monotonic()
+        idle = [cid for cid, room in classes.items()
+                if now - room.get("_last_active", now) > ROOM_IDLE_TIMEOUT and not room_has_clients(cid)]
+        if not idle:
+            continue
+        # only the idle classes: a busy one is snapshotted when its journal is due
+        await flush_persistence(compact=idle)
+        for class_id in idle:
+            # someone may have joined while the flush was running
+            if class_id not in pending_lines and not room_has_clients(class_id):
+                classes.pop(class_id, None)
+
+async def start_persistence(app):
+    app["persistence_worker"] = asyncio.ensure_future(persistence_worker())
+    app["room_evictor"] = asyncio.ensure_future(evict_idle_rooms())
+
+async def stop_persistence(app):
+    # an on_cleanup hook: by now every connection handler has finished, so nothing changes a room after this flush
+    app["persistence_worker"].cancel()
+    app["room_evictor"].cancel()
+    await flush_persistence(compact=list(classes))
+    persist_executor.shutdown()
 
 # ---------------- Utilities ----------------
 def new_class_id():
@@ -57,20 +588,1207 @@ def new_teacher_key():
 def new_student_token():
     return secrets.token_urlsafe(8)
 
-async def send_json(ws, payload):
-    try:
-        await ws.send_str(json.dumps(payload))
-    except Exception:
+# ---------------- Outbound queues ----------------
+# Frames carrying stroke points, which are encoded once per codec rather than once overall
+STROKE_FRAMES = {"apply_stroke", "apply_strokes", "init_strokes", "page_strokes", "stroke_begin", "stroke_points", "stroke_end"}
+# Frames a lagging client can skip: the current strokes, sent as one
+# init_strokes, supersede every one of them.
+RESYNC_SUPERSEDES = {"apply_stroke", "apply_strokes", "init_strokes", "page_strokes", "remove_strokes", "clear_annotations", "stroke_begin", "stroke_points", "stroke_end"}
+
+class Frame:
+    """One encoded message, shared by every outbox it is queued on."""
+
+    __slots__ = ("kind", "data", "_text")
+
+    def __init__(self, payload, codec="json"):
+        self.kind = payload.get("type")
+        if self.kind in STROKE_FRAMES:
+            payload = convert_strokes(payload, codec)
+        self.data = encode(payload)
+        self._text = None
+
+    @classmethod
+    def encoded(cls, kind, data):
+        """A frame someone else already encoded (relayed over the backplane)."""
+        frame = cls.__new__(cls)
+        frame.kind, frame.data, frame._text = kind, data, None
+        return frame
+
+    @property
+    def text(self):
+        # only needed when aiohttp cannot send bytes as a text frame; decoded once, not per recipient
+        if self._text is None:
+            self._text = self.data.decode("utf-8")
+        return self._text
+
+class Outbox:
+    """Bounded send queue of one connection, drained by its own writer task."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.overflows = 0
+        self.closed = False
+        self.writer = asyncio.ensure_future(self.run())
+
+    def push(self, frame):
+        """Queue a frame; False when the queue is full."""
+        if self.closed:
+            return True
+        if len(self.frames) >= OUTBOX_MAX:
+            return False
+        self.frames.append(frame)
+        self.ready.set()
+        return True
+
+    def drop(self, kinds):
+        kept = deque(f for f in self.frames if f.kind not in kinds)
+        dropped = len(self.frames) - len(kept)
+        self.frames = kept
+        return dropped
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.writer.cancel()
+
+    async def run(self):
+        while True:
+            if not self.frames:
+                self.overflows = 0
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            frame = self.frames.popleft()
+            try:
+                if SEND_FRAME:
+                    await self.ws.send_frame(frame.data, WSMsgType.TEXT)
+                else:
+                    await self.ws.send_str(frame.text)
+            except Exception:
+                self.closed = True
+                return
+            metrics["frames_sent"] += 1
+
+def deliver(info, frame):
+    out = info["outbox"]
+    if out.push(frame):
+        return
+    out.overflows += 1
+    room = classes.get(info.get("class_id"))
+    dropped = out.drop(RESYNC_SUPERSEDES)
+    metrics["frames_dropped"] += dropped
+    if dropped and (room is not None or info["owner"] is not None) and out.overflows <= SLOW_CLIENT_OVERFLOWS:
+        metrics["resyncs"] += 1
+        if room is not None:
+            # the room already reflects the frame being delivered, so the snapshot covers it too
+            out.push(Frame(init_strokes_payload(info, room), info["codec"]))
+        else:
+            # a socket relayed to the class's owner: only the owner has the room, and it
+            # answers with an init_strokes that comes after everything it sent before
+            backplane_send(info["owner"], {"op": "resync", "client": info["id"]})
+        if frame.kind not in RESYNC_SUPERSEDES:
+            out.push(frame)
+        return
+    # a client this far behind will not read a close frame either; drop the socket
+    metrics["slow_disconnects"] += 1
+    out.close()
+    info["transport"].abort()
+
+def send_json(info, payload):
+    deliver(info, Frame(payload, info["codec"]))
+
+class TokenBucket:
+    """Allows rate units per second on average, and bursts of up to burst units."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, n=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+def new_client(client_id, ws, transport, outbox):
+    # "room" is classes[class_id] while joined (a class with clients is never evicted);
+    # "owner" is the worker handling this connection's class when that is not us
+    return {"id": client_id, "ws": ws, "transport": transport, "outbox": outbox, "class_id": None, "room": None, "role": None, "name": None, "token": None,
+            "features": set(), "codec": "json", "live": {}, "owner": None,
+            "msg_bucket": TokenBucket(MSG_RATE, MSG_RATE * RATE_BURST), "point_bucket": TokenBucket(POINT_RATE, POINT_RATE * RATE_BURST),
+            "throttled": False}
+
+def index_client(client_id):
+    info = clients[client_id]
+    class_clients.setdefault(info["class_id"], {})[client_id] = info
+    token_clients.setdefault((info["class_id"], info["token"]), {})[client_id] = info
+
+def unindex_client(client_id):
+    info = clients.get(client_id)
+    if not info or not info.get("class_id"):
+        return
+    for index, key in ((class_clients, info["class_id"]), (token_clients, (info["class_id"], info["token"]))):
+        members = index.get(key)
+        if members is not None:
+            members.pop(client_id, None)
+            if not members:
+                del index[key]
+
+def presence_list(class_id, ids=None):
+    """Named clients of a class, in join order: all of them, or those of ids still there."""
+    members = class_clients.get(class_id, {})
+    participants = []
+    for cid in members if ids is None else ids:
+        info = members.get(cid)
+        if info is not None and info.get("name"):
+            participants.append({"id": cid, "name": info.get("name"), "role": info.get("role")})
+    return participants
+
+def note_presence(class_id, client_id, joined):
+    """Queue a join or leave for the class's next flush_presence."""
+    room = classes.get(class_id)
+    if room is None:
+        return
+    room["_presence_joined" if joined else "_presence_left"][client_id] = None
+    if room["_presence_handle"] is None:
+        room["_presence_handle"] = asyncio.get_running_loop().call_later(PRESENCE_DEBOUNCE, flush_presence, class_id, room)
+
+def flush_presence(class_id, room):
+    """Tell a class who came and went: presence_leave then presence_join for "presence" clients, the whole list for the rest."""
+    room["_presence_handle"] = None
+    left, joined = room["_presence_left"], room["_presence_joined"]
+    room["_presence_left"], room["_presence_joined"] = {}, {}
+    # an id both left and joined rejoined; one that left for good is not listed by presence_list
+    if left:
+        broadcast_class(class_id, {"type":"presence_leave", "ids": list(left)}, where=supports("presence"))
+    arrived = presence_list(class_id, joined)
+    if arrived:
+        broadcast_class(class_id, {"type":"presence_join", "clients": arrived}, where=supports("presence"))
+    broadcast_class(class_id, {"type":"presence", "clients": presence_list(class_id)}, where=lacks("presence"))
+
+def send_many(members, payload, where=None):
+    frames = {}
+    # a slow consumer can be disconnected (and unindexed) mid-loop
+    for info in list(members.values()):
+        if where is not None and not where(info):
+            continue
+        codec = info["codec"] if payload.get("type") in STROKE_FRAMES else "json"
+        frame = frames.get(codec)
+        if frame is None:
+            # encoded once per codec; every recipient queues the same bytes
+            frame = frames[codec] = Frame(payload, codec)
+        deliver(info, frame)
+
+def broadcast_class(class_id, payload, where=None):
+    send_many(class_clients.get(class_id, {}), payload, where)
+
+def send_to_token(class_id, token, payload):
+    send_many(token_clients.get((class_id, token), {}), payload)
+
+# ---------------- Backplane ----------------
+# Workers exchange envelopes: a JSON header line, then an opaque body.
+#   {"op":"msg",   "client":..., "from": worker}   body: a client message, for the owner
+#   {"op":"close", "client":...}                   the client disconnected or left the class
+#   {"op":"resync", "client":...}                  its host dropped frames it fell behind on; send init_strokes
+#   {"op":"frame", "kind":..., "clients": [...]}   body: an encoded Frame, for the host worker
+# (client, worker) pairs stay in order, which is all the protocol needs.
+def class_owner(class_id):
+    if WORKERS == 1 or not isinstance(class_id, str):
+        return WORKER_ID
+    return zlib.crc32(class_id.encode("utf-8")) % WORKERS
+
+def hub_frame(channel, data):
+    return struct.pack(">HI", len(channel), len(data)) + channel + data
+
+async def read_hub_frame(reader):
+    channel_len, data_len = struct.unpack(">HI", await reader.readexactly(6))
+    channel = await reader.readexactly(channel_len)
+    return channel, await reader.readexactly(data_len)
+
+class LocalBackplane:
+    """One worker: every class is local and nothing is ever published."""
+
+    async def start(self, on_message):
+        pass
+
+    def publish(self, worker, data):
+        raise RuntimeError("WORKERS > 1 needs a BACKPLANE")
+
+    async def stop(self):
         pass
 
-async def broadcast_class(class_id, payload):
-    data = json.dumps(payload)
-    for cid, info in list(clients.items()):
-        if info.get("class_id") == class_id:
+class UnixBackplane:
+    """Connection to the hub (run_hub) over a Unix socket."""
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.reader_task = None
+
+    async def start(self, on_message):
+        for _ in range(50):
+            try:
+                reader = await self.connect()
+                break
+            except OSError:
+                # the supervisor may still be starting the hub
+                await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError("No backplane hub at " + self.path)
+        self.reader_task = asyncio.ensure_future(self.read(reader, on_message))
+
+    async def connect(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        # an empty channel registers the one we receive on
+        self.writer.write(hub_frame(b"", f"worker.{WORKER_ID}".encode()))
+        return reader
+
+    async def read(self, reader, on_message):
+        while True:
+            try:
+                while True:
+                    _, data = await read_hub_frame(reader)
+                    on_message(data)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                print("Backplane hub went away, reconnecting")
+            self.writer.close()
+            self.writer = None
+            backplane_lost()
+            delay = 0.1
+            while True:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BACKPLANE_RETRY_MAX)
+                try:
+                    reader = await self.connect()
+                    break
+                except OSError:
+                    pass
+
+    def publish(self, worker, data):
+        if self.writer is None:
+            metrics["backplane_dropped"] += 1
+            return
+        self.writer.write(hub_frame(f"worker.{worker}".encode(), data))
+
+    async def stop(self):
+        self.reader_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+class RedisBackplane:
+    """Redis pub/sub, one channel per worker."""
+
+    def __init__(self, url):
+        if aioredis is None:
+            raise RuntimeError("BACKPLANE=" + url + " needs the redis package (pip install redis)")
+        self.url = url
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.up = False
+        self.task = None
+
+    async def start(self, on_message):
+        self.redis = aioredis.from_url(self.url)
+        await self.subscribe()
+        self.task = asyncio.ensure_future(self.run(on_message))
+
+    async def subscribe(self):
+        self.pubsub = self.redis.pubsub()
+        await self.pubsub.subscribe(f"worker.{WORKER_ID}")
+        self.up = True
+
+    async def run(self, on_message):
+        """Relay both ways until either direction fails, then resubscribe with backoff."""
+        while True:
+            tasks = [asyncio.ensure_future(self.read(on_message)), asyncio.ensure_future(self.write())]
             try:
-                await info["ws"].send_str(data)
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            print("Backplane connection failed, reconnecting:", next(iter(done)).exception())
+            # nothing is kept for later: the clients it was for are reset by backplane_lost
+            self.up = False
+            self.queue.clear()
+            backplane_lost()
+            try:
+                await self.pubsub.close()
             except Exception:
                 pass
+            delay = 0.1
+            while True:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, BACKPLANE_RETRY_MAX)
+                try:
+                    await self.subscribe()
+                    break
+                except Exception as e:
+                    print("Backplane reconnect failed:", e)
+
+    async def read(self, on_message):
+        async for message in self.pubsub.listen():
+            if message["type"] == "message":
+                on_message(message["data"])
+        raise ConnectionError("subscription ended")
+
+    async def write(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch, self.queue = self.queue, deque()
+            # one round trip for everything published since the last one, still in order
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for channel, data in batch:
+                    pipe.publish(channel, data)
+                await pipe.execute()
+
+    def publish(self, worker, data):
+        if not self.up:
+            metrics["backplane_dropped"] += 1
+            return
+        self.queue.append((f"worker.{worker}", data))
+        self.wakeup.set()
+
+    async def stop(self):
+        self.task.cancel()
+        await self.pubsub.close()
+        await self.redis.close()
+
+def make_backplane(spec):
+    if spec.startswith("unix:"):
+        return UnixBackplane(spec[len("unix:"):])
+    if spec.startswith(("redis://", "rediss://")):
+        return RedisBackplane(spec)
+    if spec:
+        raise ValueError("Unknown BACKPLANE " + spec)
+    return LocalBackplane()
+
+backplane = make_backplane(BACKPLANE)
+# worker -> [(frame, [client_id, ...]), ...] waiting to be published
+remote_frames = {}
+
+def backplane_send(worker, header, body=b""):
+    metrics["backplane_out"] += 1
+    backplane.publish(worker, encode(header) + b"\n" + body)
+
+def flush_remote_frames():
+    global remote_frames
+    batch, remote_frames = remote_frames, {}
+    for worker, frames in batch.items():
+        for frame, client_ids in frames:
+            backplane_send(worker, {"op": "frame", "kind": frame.kind, "clients": client_ids}, frame.data)
+
+class RemoteOutbox:
+    """Outbox of a proxied client: frames go to the worker holding its socket."""
+
+    def __init__(self, worker, client_id):
+        self.worker = worker
+        self.client_id = client_id
+        self.frames = ()
+
+    def push(self, frame):
+        batches = remote_frames.get(self.worker)
+        if batches is None:
+            if not remote_frames:
+                asyncio.get_running_loop().call_soon(flush_remote_frames)
+            batches = remote_frames[self.worker] = []
+        # a broadcast reaches all of one worker's clients in a single envelope
+        if batches and batches[-1][0] is frame:
+            batches[-1][1].append(self.client_id)
+        else:
+            batches.append((frame, [self.client_id]))
+        return True
+
+    def drop(self, kinds):
+        return 0
+
+    def close(self):
+        pass
+
+def route_join(client_id, me, data):
+    """Point a connection at the worker owning the class it joins."""
+    owner = class_owner(data.get("class_id"))
+    owner = None if owner == WORKER_ID else owner
+    if me["owner"] is not None and me["owner"] != owner:
+        backplane_send(me["owner"], {"op": "close", "client": client_id})
+    elif me["owner"] is None and owner is not None:
+        leave_class(client_id)
+    me["owner"] = owner
+
+# client id -> (header, body) of its messages from the backplane, while run_remote handles them
+remote_queues = {}
+
+def on_backplane_message(data):
+    metrics["backplane_in"] += 1
+    header, _, body = data.partition(b"\n")
+    header = decode(header)
+    if header["op"] == "frame":
+        frame = Frame.encoded(header["kind"], body)
+        for client_id in header["clients"]:
+            info = clients.get(client_id)
+            if info is not None:
+                deliver(info, frame)
+        return
+    # a join for a cold class waits on a disk read; that holds up this client, not the backplane
+    queue = remote_queues.get(header["client"])
+    if queue is None:
+        queue = remote_queues[header["client"]] = deque()
+        asyncio.ensure_future(run_remote(header["client"], queue))
+    queue.append((header, body))
+
+async def run_remote(client_id, queue):
+    """Handle a proxied client's msg, resync and close envelopes in order."""
+    try:
+        while queue:
+            header, body = queue.popleft()
+            try:
+                if header["op"] == "msg":
+                    info = clients.get(client_id)
+                    if info is None:
+                        info = clients[client_id] = new_client(client_id, None, None, RemoteOutbox(header["from"], client_id))
+                    await handle_message(client_id, info, decode(body))
+                elif header["op"] == "resync":
+                    info = clients.get(client_id)
+                    if info is not None and info["room"] is not None:
+                        send_json(info, init_strokes_payload(info, info["room"]))
+                elif header["op"] == "close":
+                    drop_client(client_id)
+            except Exception as e:
+                print("Backplane message failed:", header["op"], e)
+    finally:
+        del remote_queues[client_id]
+
+def backplane_lost():
+    """The link to the other workers broke and envelopes were lost both ways: forget the clients
+    proxied here, and close the sockets relayed from here so that their browsers rejoin."""
+    for client_id, info in list(clients.items()):
+        if isinstance(info["outbox"], RemoteOutbox):
+            drop_client(client_id)
+        elif info["owner"] is not None and info["ws"] is not None:
+            asyncio.ensure_future(info["ws"].close(code=1013, message=b"backplane reconnecting"))
+
+async def start_backplane(app):
+    if ROUTING not in ("backplane", "affinity"):
+        raise ValueError("Unknown ROUTING " + ROUTING)
+    if WORKERS > 1 and ROUTING == "backplane" and isinstance(backplane, LocalBackplane):
+        raise RuntimeError("WORKERS > 1 needs a BACKPLANE")
+    await backplane.start(on_backplane_message)
+
+async def stop_backplane(app):
+    await backplane.stop()
+
+async def run_hub(path):
+    """Relay frames between workers: each registers its channel, then every frame goes to the channel it names."""
+    subscribers = {}
+
+    async def serve(reader, writer):
+        name = None
+        try:
+            while True:
+                channel, data = await read_hub_frame(reader)
+                if not channel:
+                    name = data
+                    subscribers[name] = writer
+                    continue
+                target = subscribers.get(channel)
+                if target is not None:
+                    target.write(hub_frame(channel, data))
+                    await target.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if name is not None and subscribers.get(name) is writer:
+                del subscribers[name]
+            writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(serve, path)
+    async with server:
+        await server.serve_forever()
+
+async def supervise():
+    """Run WORKERS copies of this server on one port (SO_REUSEPORT) around a hub."""
+    if ROUTING == "affinity":
+        # connections are piped to their owner, so nothing goes over a backplane
+        spec = BACKPLANE
+    else:
+        spec = BACKPLANE or "unix:" + os.path.join(STATE_DIR, "backplane.sock")
+    hub = asyncio.ensure_future(run_hub(spec[len("unix:"):])) if spec.startswith("unix:") else None
+    procs = []
+    try:
+        for worker in range(WORKERS):
+            env = dict(os.environ, WORKER_ID=str(worker), BACKPLANE=spec)
+            procs.append(await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env))
+        await asyncio.gather(*(p.wait() for p in procs))
+    finally:
+        for p in procs:
+            if p.returncode is None:
+                p.terminate()
+        await asyncio.gather(*(p.wait() for p in procs))
+        if hub is not None:
+            hub.cancel()
+
+# ---------------- Class affinity ----------------
+# ROUTING=affinity: a worker that gets a join for a class it does not own pipes the
+# connection, frame for frame, to the owner's Unix socket. The owner serves it like
+# any other local client, so its stroke path never touches the backplane.
+owner_sessions = {}
+
+def worker_socket(worker):
+    return os.path.join(STATE_DIR, f"worker-{worker}.sock")
+
+def owner_session(worker):
+    session = owner_sessions.get(worker)
+    if session is None:
+        session = owner_sessions[worker] = ClientSession(connector=UnixConnector(path=worker_socket(worker)))
+    return session
+
+async def pipe_frames(source, sink):
+    async for msg in source:
+        if msg.type == WSMsgType.TEXT:
+            await sink.send_str(msg.data)
+        elif msg.type == WSMsgType.BINARY:
+            await sink.send_bytes(msg.data)
+
+async def relay_to_owner(ws, owner, first):
+    """Pipe a connection to the worker owning its class until either side closes.
+
+    A later join for a class owned by another worker moves the pipe there (back
+    through our own socket if that is us)."""
+    metrics["affinity_relays"] += 1
+    while True:
+        try:
+            upstream = await owner_session(owner).ws_connect("http://worker/ws")
+        except (ClientError, OSError) as e:
+            print("Owner worker unavailable:", owner, e)
+            await ws.close(code=1013, message=b"worker unavailable")
+            return
+        downstream = asyncio.ensure_future(pipe_frames(upstream, ws))
+        # the owner going away ends the client's connection too; it rejoins (and resumes) later
+        downstream.add_done_callback(lambda task: task.cancelled() or asyncio.ensure_future(ws.close()))
+        moved = None
+        try:
+            await upstream.send_str(first)
+            async for raw in ws:
+                if raw.type != WSMsgType.TEXT:
+                    continue
+                # only a join can move the connection; everything else goes through undecoded
+                if '"join"' in raw.data:
+                    try:
+                        data = decode(raw.data)
+                    except Exception:
+                        data = {}
+                    if data.get("type") == "join" and class_owner(data.get("class_id")) != owner:
+                        moved = data
+                        break
+                await upstream.send_str(raw.data)
+        finally:
+            downstream.cancel()
+            await upstream.close()
+        if moved is None:
+            return
+        owner, first = class_owner(moved.get("class_id")), raw.data
+
+async def stop_affinity(app):
+    for session in owner_sessions.values():
+        await session.close()
+
+# ---------------- Strokes ----------------
+# Optional protocol extensions a client can ask for with "features" in join;
+# "joined" echoes the ones the server accepted.
+#   stream: stroke_begin / stroke_points / stroke_end instead of one "stroke" on pen-up
+#   q16:    stroke points travel packed as "p" (see Stroke encoding), both ways
+#   paged:  init_strokes carries one page plus the list of annotated pages;
+#           the rest are fetched with get_page_strokes
+#   ids:    strokes carry server ids, own strokes are confirmed with stroke_ack,
+#           and clears and undo send remove_strokes instead of init_strokes
+#   resume: (with ids) a join carrying last_seq gets the stroke changes it
+#           missed instead of init_strokes, while they are still buffered
+#   batch:  (with ids) new strokes come once per BROADCAST_TICK as one apply_strokes;
+#           a stroke may then also arrive in a snapshot, so clients skip known ids
+#   presence: after the whole "presence" list on joining, changes come as
+#           presence_leave (ids) and presence_join (clients), both as upserts
+#           and deletes by id, instead of the whole list again every time
+SERVER_FEATURES = {"stream", "q16", "paged", "ids", "resume", "batch", "presence"}
+# streamed strokes one connection may have open at once
+MAX_LIVE_STROKES = 4
+
+def supports(feature):
+    return lambda info: feature in info["features"]
+
+def lacks(feature):
+    return lambda info: feature not in info["features"]
+
+def stroke_author(info, room):
+    """Author id the connection draws as, or None when it may not annotate right now."""
+    if info.get("role") == "teacher":
+        return "teacher"
+    student_token = info.get("token")
+    if room.get("students", {}).get(student_token, {}).get("allowed") != True or room.get("current_annotator") != student_token:
+        return None
+    if room.get("last_student_annotator") != student_token:
+        room["last_student_annotator"] = student_token
+        journal_meta(info["class_id"])
+    return student_token
+
+def farthest_point(coords, i, j):
+    """Index and distance of the point strictly between i and j farthest from segment i-j."""
+    ax, ay = coords[i]
+    dx, dy = coords[j][0] - ax, coords[j][1] - ay
+    seg2 = dx * dx + dy * dy
+    best, best_d2 = i, -1.0
+    for k in range(i + 1, j):
+        px, py = coords[k][0] - ax, coords[k][1] - ay
+        t = 0.0 if seg2 == 0 else min(1.0, max(0.0, (px * dx + py * dy) / seg2))
+        ex, ey = px - t * dx, py - t * dy
+        d2 = ex * ex + ey * ey
+        if d2 > best_d2:
+            best, best_d2 = k, d2
+    return best, best_d2 ** 0.5
+
+def farthest_point_numpy(coords, i, j):
+    a = coords[i]
+    seg = coords[j] - a
+    rel = coords[i + 1:j] - a
+    seg2 = float(seg @ seg)
+    t = numpy.zeros(len(rel)) if seg2 == 0 else numpy.clip(rel @ seg / seg2, 0.0, 1.0)
+    dist = numpy.hypot(*(rel - numpy.outer(t, seg)).T)
+    k = int(numpy.argmax(dist))
+    return i + 1 + k, float(dist[k])
+
+def simplify_points(points, tolerance):
+    """Ramer-Douglas-Peucker: keep the fewest points whose polyline stays within tolerance of the original."""
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    coords = [(quantize(p.get("x")) / Q16_SCALE, quantize(p.get("y")) / Q16_SCALE) if isinstance(p, dict) else (0.0, 0.0)
+              for p in points]
+    array = None
+    keep = [False] * len(points)
+    # window ends are always kept, so a pathological stroke costs O(n * SIMPLIFY_WINDOW), not O(n^2)
+    bounds = list(range(0, len(points) - 1, SIMPLIFY_WINDOW)) + [len(points) - 1]
+    for b in bounds:
+        keep[b] = True
+    # explicit stack: long strokes would blow the recursion limit
+    spans = list(zip(bounds, bounds[1:]))
+    while spans:
+        i, j = spans.pop()
+        if j - i < 2:
+            continue
+        if numpy is not None and j - i > SIMPLIFY_NUMPY_SPAN:
+            if array is None:
+                array = numpy.asarray(coords)
+            k, dist = farthest_point_numpy(array, i, j)
+        else:
+            k, dist = farthest_point(coords, i, j)
+        if dist > tolerance:
+            keep[k] = True
+            spans.append((i, k))
+            spans.append((k, j))
+    return [p for p, kept in zip(points, keep) if kept]
+
+def commit_stroke(class_id, room, page, entry):
+    points = entry.get("points")
+    if points:
+        entry["points"] = simplify_points(points, SIMPLIFY_TOLERANCE)
+        metrics["stroke_points_in"] += len(points)
+        metrics["stroke_points_kept"] += len(entry["points"])
+    entry = add_stroke(room, page, pack_stroke(entry))
+    journal_stroke(class_id, page, entry)
+    history(room, "_undo", entry["author"]).append(entry["id"])
+    # a new stroke forks the history, as in any editor
+    room["_redo"].pop(entry["author"], None)
+    return entry
+
+def history(room, key, author):
+    return room[key].setdefault(author, deque(maxlen=UNDO_HISTORY))
+
+def undo_stroke(class_id, room, author):
+    """Remove author's newest undoable stroke; returns (page, entry) or None."""
+    undo = room["_undo"].get(author)
+    while undo:
+        removed = remove_stroke(room, author, undo.pop())
+        if removed is not None:
+            journal_remove(class_id, author, [removed[1]["id"]])
+            history(room, "_redo", author).append(removed)
+            return removed
+    return None
+
+def redo_stroke(class_id, room, author):
+    """Put back author's most recently undone stroke, id unchanged; returns (page, entry) or None."""
+    redo = room["_redo"].get(author)
+    if not redo:
+        return None
+    page, entry = redo.pop()
+    add_stroke(room, page, entry)
+    journal_stroke(class_id, page, entry)
+    history(room, "_undo", author).append(entry["id"])
+    return page, entry
+
+def page_key(value):
+    """A page number from a message as a room page key ("1", "2", ...), or None when it is not one."""
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        value = int(value)
+    if type(value) is not int or value < 1:
+        return None
+    return str(value)
+
+def stroke_points_arg(data):
+    """Points of a stroke message, whether sent as a list or packed into "p"."""
+    if "p" in data:
+        try:
+            return unpack_points(data["p"])
+        except ValueError:
+            return []
+    points = data.get("points")
+    return points if isinstance(points, list) else []
+
+def live_strokes(class_id):
+    """Streamed strokes still being drawn in a class."""
+    live = []
+    for info in class_clients.get(class_id, {}).values():
+        live.extend(info["live"].values())
+    return live
+
+def push_delta(class_id, room, payload, where=None):
+    """Broadcast a stroke change stamped with the class seq, keeping it for clients that resume."""
+    # held strokes are older than this change, so they go first
+    flush_strokes(class_id, room)
+    payload["seq"] = room["seq"]
+    room["_deltas"].append(payload)
+    broadcast_class(class_id, payload, where)
+
+def hold_stroke(class_id, room, payload, where=None):
+    """push_delta for an apply_stroke, held until the class's next tick for "batch" clients."""
+    payload["seq"] = room["seq"]
+    room["_deltas"].append(payload)
+    broadcast_class(class_id, payload, lambda info: "batch" not in info["features"] and (where is None or where(info)))
+    room["_held_strokes"].append((payload, where))
+    if room["_flush_handle"] is None:
+        room["_flush_handle"] = asyncio.get_running_loop().call_later(BROADCAST_TICK, flush_strokes, class_id, room)
+
+def flush_strokes(class_id, room):
+    """Send held strokes to "batch" clients: one apply_strokes each, with the strokes its filters let through."""
+    held = room["_held_strokes"]
+    if room["_flush_handle"] is not None:
+        room["_flush_handle"].cancel()
+        room["_flush_handle"] = None
+    if not held:
+        return
+    room["_held_strokes"] = []
+    metrics["stroke_batches"] += 1
+    metrics["stroke_batch_strokes"] += len(held)
+    # clients seeing the same strokes (usually everyone but each stroke's sender) share one frame
+    groups = {}
+    for client_id, info in class_clients.get(class_id, {}).items():
+        if "batch" in info["features"]:
+            shown = tuple(i for i, (_, where) in enumerate(held) if where is None or where(info))
+            if shown:
+                groups.setdefault(shown, {})[client_id] = info
+    seq = held[-1][0]["seq"]
+    for shown, members in groups.items():
+        send_many(members, {"type":"apply_strokes", "strokes": [held[i][0]["stroke"] for i in shown], "seq": seq})
+
+def with_seq(room, payload):
+    """Stamp a frame sent outside push_delta with the class seq, unless "batch" clients have yet to get held strokes."""
+    if not room["_held_strokes"]:
+        payload["seq"] = room["seq"]
+    return payload
+
+def missed_deltas(room, last_seq):
+    """Stroke changes after last_seq, or None when they are no longer all buffered."""
+    if type(last_seq) is not int or not 0 <= last_seq <= room["seq"]:
+        return None
+    deltas = room["_deltas"]
+    if last_seq < room["seq"] and (not deltas or deltas[0]["seq"] > last_seq + 1):
+        return None
+    return [d for d in deltas if d["seq"] > last_seq]
+
+def broadcast_removal(class_id, room, ids):
+    """Tell a class that strokes were removed: their ids, or the whole document for clients without "ids"."""
+    if not ids:
+        return
+    push_delta(class_id, room, {"type":"remove_strokes", "ids": ids}, where=supports("ids"))
+    if any("ids" not in info["features"] for info in class_clients.get(class_id, {}).values()):
+        broadcast_class(class_id, {"type":"init_strokes", "strokes": stroke_pages(room), "seq": room["seq"]}, where=lacks("ids"))
+
+def init_strokes_payload(info, room, page=None):
+    strokes = room["strokes"]
+    if "paged" in info["features"]:
+        page = page or room.get("_current_page", "1")
+        payload = {"type":"init_strokes", "paged": True, "page": page, "pages": list(strokes),
+                   "strokes": {page: list(strokes[page].values())} if page in strokes else {}}
+    else:
+        payload = {"type":"init_strokes", "strokes": stroke_pages(room)}
+    payload["seq"] = room["seq"]
+    if "stream" in info["features"]:
+        payload["live"] = live_strokes(info["class_id"])
+    return payload
+
+# ---------------- Uploaded PDFs ----------------
+# uploads/<sha256>.pdf holds each distinct document once, whichever classes use it;
+# uploads/refs/<sha256>/ has an empty file per such class, and the blob goes with
+# its last reference. (Classes from before keep their own <uuid>.pdf.)
+PDF_REFS_DIR = os.path.join(UPLOAD_DIR, "refs")
+BLOB_RE = re.compile(r"^[0-9a-f]{64}\.pdf$")
+# sweep_uploads leaves anything younger alone: it may belong to an upload or class still being created
+UPLOAD_SWEEP_AGE = 3600
+
+def retain_pdf(sha256, class_id):
+    refs = os.path.join(PDF_REFS_DIR, sha256)
+    os.makedirs(refs, exist_ok=True)
+    open(os.path.join(refs, class_id), "wb").close()
+
+def release_pdf(sha256, class_id):
+    refs = os.path.join(PDF_REFS_DIR, sha256)
+    try:
+        os.unlink(os.path.join(refs, class_id))
+        os.rmdir(refs)
+    except OSError:
+        # other classes still use it
+        return
+    for suffix in ("", ".gz", ".br"):
+        try:
+            os.unlink(os.path.join(UPLOAD_DIR, f"{sha256}.pdf{suffix}"))
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(os.path.join(PAGE_CACHE_DIR, sha256), ignore_errors=True)
+
+def store_pdf(tmppath, sha256, class_id):
+    """Move a received upload into place under its hash for class_id; (filename, whether it was already stored)."""
+    filename = f"{sha256}.pdf"
+    outpath = os.path.join(UPLOAD_DIR, filename)
+    # referenced before it exists, so a sweep never sees the blob without a reference
+    retain_pdf(sha256, class_id)
+    try:
+        # fails if it exists, so of two uploads of the same new document only one stores it
+        os.link(tmppath, outpath)
+        reused = False
+    except FileExistsError:
+        reused = True
+    os.unlink(tmppath)
+    if PRECOMPRESS_PDFS and not reused:
+        precompress(outpath)
+    return filename, reused
+
+def precompress(path):
+    """Write path + ".gz" next to a stored PDF, unless it barely compresses or is there already."""
+    if os.path.exists(path + ".gz"):
+        return
+    tmppath = f"{path}.gz.{uuid.uuid4().hex}.part"
+    with open(path, "rb") as fin, gzip.open(tmppath, "wb") as fout:
+        shutil.copyfileobj(fin, fout, UPLOAD_CHUNK)
+    if os.path.getsize(tmppath) < os.path.getsize(path) * 0.9:
+        os.replace(tmppath, path + ".gz")
+    else:
+        os.unlink(tmppath)
+
+def sweep_uploads():
+    """Release references of classes that no longer exist, and drop stale partial uploads."""
+    now = time.time()
+    stale = lambda path: now - os.path.getmtime(path) > UPLOAD_SWEEP_AGE
+    if os.path.isdir(PDF_REFS_DIR):
+        for sha256 in os.listdir(PDF_REFS_DIR):
+            for class_id in os.listdir(os.path.join(PDF_REFS_DIR, sha256)):
+                try:
+                    if not class_exists(class_id) and stale(os.path.join(PDF_REFS_DIR, sha256, class_id)):
+                        release_pdf(sha256, class_id)
+                except OSError:
+                    pass
+    for name in os.listdir(UPLOAD_DIR):
+        path = os.path.join(UPLOAD_DIR, name)
+        try:
+            if name.endswith(".part") and stale(path):
+                os.unlink(path)
+            elif BLOB_RE.match(name) and not os.path.isdir(os.path.join(PDF_REFS_DIR, name[:-len(".pdf")])) and stale(path):
+                os.unlink(path)
+        except OSError:
+            pass
+
+PDF_MAGIC = b"%PDF-"
+
+def write_upload_chunk(fout, digest, chunk):
+    digest.update(chunk)
+    fout.write(chunk)
+
+async def receive_pdf(part):
+    """Stream an uploaded file into UPLOAD_DIR, hashing it on the way; (temporary path, sha256).
+
+    Raises ValueError("not-pdf") or ValueError("too-large") as soon as the data shows it."""
+    loop = asyncio.get_running_loop()
+    # a temporary name until store_pdf knows the hash, so a half-received upload is never served
+    tmppath = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}.part")
+    digest = hashlib.sha256()
+    head = b""
+    size = 0
+    fout = await loop.run_in_executor(None, open, tmppath, "wb")
+    try:
+        while True:
+            chunk = await part.read_chunk(UPLOAD_CHUNK)
+            if not chunk:
+                break
+            if len(head) < len(PDF_MAGIC):
+                head = (head + chunk)[:len(PDF_MAGIC)]
+                if not PDF_MAGIC.startswith(head):
+                    raise ValueError("not-pdf")
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise ValueError("too-large")
+            # hashing and writing release the GIL, so other requests keep running meanwhile
+            await loop.run_in_executor(None, write_upload_chunk, fout, digest, chunk)
+        if head != PDF_MAGIC:
+            raise ValueError("not-pdf")
+    except BaseException:
+        await loop.run_in_executor(None, fout.close)
+        os.unlink(tmppath)
+        raise
+    await loop.run_in_executor(None, fout.close)
+    return tmppath, digest.hexdigest()
+
+async def start_upload_sweep(app):
+    # one worker is enough; the others share uploads/
+    if WORKER_ID == 0:
+        asyncio.get_running_loop().run_in_executor(None, sweep_uploads)
+
+# ---------------- Page images ----------------
+# RASTER_PAGES=1: /pages/<doc> describes a stored PDF (<doc>.pdf in uploads/) and
+# /pages/<doc>/<page>?w=<pixels> is that page as an image, rendered once per
+# (page, width, format) by PyMuPDF in a process pool and then served from disk.
+PAGE_CACHE_DIR = os.path.join(UPLOAD_DIR, "pages")
+DOC_RE = re.compile(r"^(?:[0-9a-f]{32}|[0-9a-f]{64})$")
+raster_pool = None
+# image path -> future of its render, so concurrent requests share one
+rendering = {}
+# doc -> {"pages": n, "sizes": [[w, h] in points, ...]}
+doc_infos = {}
+# doc -> (width, format) pairs clients have asked for, which goto_page prefetches
+raster_variants = {}
+
+def read_doc_info(pdf_path):
+    with pymupdf.open(pdf_path) as doc:
+        sizes = [[round(page.rect.width, 2), round(page.rect.height, 2)] for page in doc]
+    return {"pages": len(sizes), "sizes": sizes}
+
+def render_page(pdf_path, page, width, fmt, out_path):
+    """Rasterize one page (1-based) to width pixels as PNG or WebP (runs in raster_pool)."""
+    tmp_path = out_path + ".part"
+    with pymupdf.open(pdf_path) as doc:
+        pdf_page = doc[page - 1]
+        zoom = width / pdf_page.rect.width
+        pix = pdf_page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+    if fmt == "webp":
+        Image.frombytes("RGB", (pix.width, pix.height), pix.samples).save(tmp_path, "WEBP", quality=80)
+    else:
+        pix.save(tmp_path, output="png")
+    os.replace(tmp_path, out_path)
+
+def get_raster_pool():
+    global raster_pool
+    if raster_pool is None:
+        # spawned, not forked: this process has an event loop and threads running
+        raster_pool = ProcessPoolExecutor(RASTER_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+    return raster_pool
+
+async def doc_info(doc):
+    info = doc_infos.get(doc)
+    if info is None:
+        pdf_path = os.path.join(UPLOAD_DIR, doc + ".pdf")
+        info = doc_infos[doc] = await asyncio.get_running_loop().run_in_executor(get_raster_pool(), read_doc_info, pdf_path)
+    return info
+
+async def render_once(out_path, render, *args):
+    """Run render(*args, out_path) in raster_pool unless out_path exists (or is being rendered); returns out_path."""
+    if os.path.exists(out_path):
+        return out_path
+    fut = rendering.get(out_path)
+    if fut is None:
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        fut = rendering[out_path] = asyncio.wrap_future(get_raster_pool().submit(render, *args, out_path))
+        fut.add_done_callback(lambda _: rendering.pop(out_path, None))
+    # one client giving up must not cancel the render the others wait for
+    await asyncio.shield(fut)
+    return out_path
+
+async def raster(doc, page, width, fmt):
+    """Path of a page image, rendering it first if it is not cached yet."""
+    out_path = os.path.join(PAGE_CACHE_DIR, doc, f"{page}-{width}.{fmt}")
+    return await render_once(out_path, render_page, os.path.join(UPLOAD_DIR, doc + ".pdf"), page, width, fmt)
+
+def raster_width(requested):
+    try:
+        requested = int(requested)
+    except (TypeError, ValueError):
+        return RASTER_WIDTHS[len(RASTER_WIDTHS) // 2]
+    return next((w for w in RASTER_WIDTHS if w >= requested), RASTER_WIDTHS[-1])
+
+async def prefetch_page(doc, page):
+    try:
+        info = await doc_info(doc)
+        if page > info["pages"]:
+            return
+        for width, fmt in list(raster_variants.get(doc, ())):
+            await raster(doc, page, width, fmt)
+    except Exception as e:
+        print("Page prefetch failed:", doc, page, e)
+
+def prefetch_pages(room, page):
+    """Render the page after the one the teacher turned to, at the sizes clients are using."""
+    doc = room["pdf_filename"][:-len(".pdf")]
+    if RASTER_PAGES and doc in raster_variants:
+        asyncio.ensure_future(prefetch_page(doc, page + 1))
+
+def pages_url(room):
+    return f"/pages/{room['pdf_filename'][:-len('.pdf')]}" if RASTER_PAGES else None
+
+async def serve_doc_info(request):
+    doc = request.match_info["doc"]
+    if not DOC_RE.match(doc) or not os.path.isfile(os.path.join(UPLOAD_DIR, doc + ".pdf")):
+        raise web.HTTPNotFound()
+    return web.json_response(dict(await doc_info(doc), widths=RASTER_WIDTHS))
+
+async def serve_page(request):
+    doc = request.match_info["doc"]
+    if not DOC_RE.match(doc) or not os.path.isfile(os.path.join(UPLOAD_DIR, doc + ".pdf")):
+        raise web.HTTPNotFound()
+    try:
+        page = int(request.match_info["page"])
+    except ValueError:
+        raise web.HTTPNotFound()
+    if not 1 <= page <= (await doc_info(doc))["pages"]:
+        raise web.HTTPNotFound()
+    width = raster_width(request.query.get("w"))
+    fmt = "webp" if Image is not None and "image/webp" in request.headers.get("Accept", "") else "png"
+    raster_variants.setdefault(doc, set()).add((width, fmt))
+    path = await raster(doc, page, width, fmt)
+    # images of a content-addressed document never change either
+    cache = IMMUTABLE if BLOB_RE.match(doc + ".pdf") else "no-cache"
+    return web.FileResponse(path, headers={"Cache-Control": cache, "Vary": "Accept", "Content-Type": f"image/{fmt}"})
+
+async def start_raster(app):
+    if RASTER_PAGES and pymupdf is None:
+        raise RuntimeError("RASTER_PAGES=1 needs PyMuPDF (pip install pymupdf)")
+
+async def stop_raster(app):
+    if raster_pool is not None:
+        raster_pool.shutdown(cancel_futures=True)
+
+# ---------------- Annotation export ----------------
+# /export/<class_id>.pdf and /export/<class_id>/<page>.png (teacher key as ?key=):
+# the class's PDF with its strokes drawn in, rendered in raster_pool and cached as
+# state/exports/<class_id>/<seq>... until the strokes change (seq moves on).
+EXPORT_DIR = os.path.join(STATE_DIR, "exports")
+# strokes are drawn with widths in canvas pixels, and the client shows pages at up to 1.8px per point
+EXPORT_PX_PER_PT = 1.8
+
+def stroke_rgb(color):
+    color = color.lstrip("#") if isinstance(color, str) else ""
+    if len(color) == 3:
+        color = "".join(c * 2 for c in color)
+    try:
+        return tuple(int(color[i:i + 2], 16) / 255 for i in (0, 2, 4))
+    except ValueError:
+        return (1, 0, 0)
+
+def draw_strokes(pdf_page, strokes):
+    rect = pdf_page.rect
+    shape = pdf_page.new_shape()
+    for stroke in strokes:
+        # normalized to the page as displayed; derotated back to PDF space
+        points = [pymupdf.Point(rect.x0 + p["x"] * rect.width, rect.y0 + p["y"] * rect.height) * pdf_page.derotation_matrix
+                  for p in stroke_points_arg(stroke)]
+        if not points:
+            continue
+        if len(points) == 1:
+            # a tap: zero-length line, drawn as a dot by the round cap
+            points.append(points[0])
+        shape.draw_polyline(points)
+        shape.finish(color=stroke_rgb(stroke.get("color")), width=(stroke.get("width") or 3) / EXPORT_PX_PER_PT,
+                     lineCap=1, lineJoin=1, closePath=False)
+    shape.commit()
+
+def drop_old_exports(out_path, seq):
+    """Remove a class's exports of earlier stroke versions."""
+    folder = os.path.dirname(out_path)
+    for name in os.listdir(folder):
+        if not name.startswith((f"{seq}.", f"{seq}-")) and not name.endswith(".part"):
+            try:
+                os.unlink(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+
+def export_pdf(pdf_path, pages, seq, out_path):
+    """Write the PDF with pages ({page: [stroke, ...]}) drawn in (runs in raster_pool)."""
+    tmp_path = out_path + ".part"
+    with pymupdf.open(pdf_path) as doc:
+        for page, strokes in pages.items():
+            # rooms from before page keys were checked can hold keys such as "cover"
+            n = int(page) - 1 if page.isascii() and page.isdigit() else -1
+            if 0 <= n < doc.page_count:
+                draw_strokes(doc[n], strokes)
+        doc.save(tmp_path, garbage=1, deflate=True)
+    os.replace(tmp_path, out_path)
+    drop_old_exports(out_path, seq)
+
+def export_png(pdf_path, page, strokes, width, seq, out_path):
+    """Write one page with its strokes as a width-pixel PNG (runs in raster_pool)."""
+    tmp_path = out_path + ".part"
+    with pymupdf.open(pdf_path) as doc:
+        pdf_page = doc[page - 1]
+        draw_strokes(pdf_page, strokes)
+        zoom = width / pdf_page.rect.width
+        pdf_page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False).save(tmp_path, output="png")
+    os.replace(tmp_path, out_path)
+    drop_old_exports(out_path, seq)
+
+async def export_room(request):
+    """The class an export request is for, once its teacher key checks out."""
+    if pymupdf is None:
+        raise web.HTTPNotImplemented(text="Export needs PyMuPDF (pip install pymupdf)")
+    class_id = request.match_info["class_id"]
+    if class_owner(class_id) == WORKER_ID:
+        room = await get_room(class_id)
+    elif class_exists(class_id):
+        # another worker owns it: read it without keeping it, at most PERSIST_DELAY behind
+        room = await asyncio.get_running_loop().run_in_executor(persist_executor, read_room, class_id)
+    else:
+        room = None
+    if room is None:
+        raise web.HTTPNotFound()
+    if request.query.get("key") != room.get("teacher_key"):
+        raise web.HTTPForbidden()
+    return class_id, room
+
+async def export_class_pdf(request):
+    class_id, room = await export_room(request)
+    seq = room["seq"]
+    pages = {page: list(strokes.values()) for page, strokes in room["strokes"].items() if strokes}
+    out_path = await render_once(os.path.join(EXPORT_DIR, class_id, f"{seq}.pdf"), export_pdf,
+                                 os.path.join(UPLOAD_DIR, room["pdf_filename"]), pages, seq)
+    return web.FileResponse(out_path, headers={"Content-Disposition": f'attachment; filename="{class_id}-annotated.pdf"'})
+
+async def export_page_png(request):
+    class_id, room = await export_room(request)
+    try:
+        page = int(request.match_info["page"])
+    except ValueError:
+        raise web.HTTPNotFound()
+    doc = room["pdf_filename"][:-len(".pdf")]
+    if not 1 <= page <= (await doc_info(doc))["pages"]:
+        raise web.HTTPNotFound()
+    seq = room["seq"]
+    width = raster_width(request.query.get("w"))
+    strokes = list(room["strokes"].get(str(page), {}).values())
+    out_path = await render_once(os.path.join(EXPORT_DIR, class_id, f"{seq}-{page}-{width}.png"), export_png,
+                                 os.path.join(UPLOAD_DIR, room["pdf_filename"]), page, strokes, width, seq)
+    return web.FileResponse(out_path)
 
 # ---------------- HTTP endpoints ----------------
 INDEX_HTML = os.path.join(BASE_DIR, "static", "index.html")
@@ -79,338 +1797,610 @@ async def index(request):
     return web.FileResponse(INDEX_HTML)
 
 async def upload_pdf(request):
-    data = await request.post()
-    pdf = data.get("pdf")
-    if not pdf:
+    pdf = None
+    if request.content_type.startswith("multipart/"):
+        reader = await request.multipart()
+        async for part in reader:
+            if getattr(part, "name", None) == "pdf" and part.filename is not None:
+                pdf = part
+                break
+    if pdf is None:
         return web.json_response({"ok": False, "error": "no-file"})
-    filename = f"{uuid.uuid4().hex}.pdf"
-    outpath = os.path.join(UPLOAD_DIR, filename)
-    with open(outpath, "wb") as fout:
-        fout.write(pdf.file.read())
+    try:
+        tmppath, sha256 = await receive_pdf(pdf)
+    except ValueError as e:
+        return web.json_response({"ok": False, "error": str(e)})
     class_id = new_class_id()
+    # keep the new class on this worker; ids are random, so that takes WORKERS tries on average
+    while class_owner(class_id) != WORKER_ID:
+        class_id = new_class_id()
+    filename, reused = await asyncio.get_running_loop().run_in_executor(None, store_pdf, tmppath, sha256, class_id)
+    if reused:
+        metrics["pdf_dedups"] += 1
     teacher_key = new_teacher_key()
     classes[class_id] = {
         "teacher_key": teacher_key,
         "pdf_filename": filename,
+        "pdf_sha256": sha256,
         "students": {},
         "pending": {},
-        "strokes": {},
         "last_student_annotator": None,
-        "current_annotator": None
+        "current_annotator": None,
+        "_last_active": time.monotonic()
     }
-    save_state()
+    hydrate_room(classes[class_id])
+    journal_meta(class_id)
     return web.json_response({"ok": True, "class_id": class_id, "teacher_key": teacher_key, "pdf_url": f"/files/{filename}"})
 
+# content-addressed files never change, so clients can keep them for good
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# checked by serve_file against the hash; FileResponse would check them against its own mtime-size ETag
+CONDITIONAL_HEADERS = ("If-Match", "If-None-Match", "If-Modified-Since", "If-Unmodified-Since", "If-Range")
+
+class BlobResponse(web.FileResponse):
+    """FileResponse prepared for a copy of the request with other headers (see serve_file)."""
+
+    def __init__(self, path, request_headers, headers):
+        super().__init__(path, headers=headers)
+        self.request_headers = request_headers
+
+    async def prepare(self, request):
+        return await super().prepare(request.clone(headers=self.request_headers))
+
 async def serve_file(request):
+    """A stored PDF; FileResponse handles Range requests."""
     fname = request.match_info["filename"]
     path = os.path.join(UPLOAD_DIR, fname)
-    if not os.path.exists(path):
+    if not os.path.isfile(path):
         raise web.HTTPNotFound()
-    return web.FileResponse(path)
+    if not BLOB_RE.match(fname):
+        # older <uuid>.pdf uploads: revalidated each time against aiohttp's mtime-size ETag
+        return web.FileResponse(path, headers={"Cache-Control": "no-cache"})
+    headers = request.headers.copy()
+    for name in CONDITIONAL_HEADERS:
+        headers.popall(name, None)
+    # the hash is the same on every host, where mtimes are not; each encoding gets its own.
+    # Ranges are always of the identity file, so a strong ETag never covers two byte sequences.
+    sha = fname[:-len(".pdf")]
+    if "Range" not in headers and "gzip" in headers.get("Accept-Encoding", "").lower() and os.path.isfile(path + ".gz"):
+        headers["Accept-Encoding"] = "gzip"
+        etag = sha + "-gz"
+    else:
+        headers.popall("Accept-Encoding", None)
+        etag = sha
+    if request.if_match is not None and not any(e.value in (etag, "*") and not e.is_weak for e in request.if_match):
+        raise web.HTTPPreconditionFailed()
+    if request.if_none_match is not None:
+        unchanged = any(e.value in (etag, "*") for e in request.if_none_match)
+    else:
+        # a blob never changes, so whatever copy the client has from any date is this one
+        unchanged = request.if_modified_since is not None
+    if unchanged:
+        return web.Response(status=304, headers={"Cache-Control": IMMUTABLE, "ETag": f'"{etag}"', "Vary": "Accept-Encoding"})
+    if_range = request.headers.get("If-Range", "")
+    # a date always matches (the file never changes); an ETag only when it is this one
+    if if_range.startswith(('"', "W/")) and if_range != f'"{etag}"':
+        headers.popall("Range", None)
+    response = BlobResponse(path, headers, {"Cache-Control": IMMUTABLE, "Vary": "Accept-Encoding"})
+    # set_content_etag sends it in place of FileResponse's
+    response["content_etag"] = etag
+    return response
+
+async def set_content_etag(request, response):
+    etag = response.get("content_etag")
+    if etag is not None and response.status in (200, 206):
+        response.etag = etag
+
+async def get_metrics(request):
+    depths = [len(info["outbox"].frames) for info in clients.values()]
+    return web.json_response(dict(metrics,
+        connections=len(clients),
+        classes_loaded=len(classes),
+        outbox_depth_max=max(depths, default=0),
+        outbox_depth_total=sum(depths),
+        outbox_limit=OUTBOX_MAX,
+        simplify_tolerance=SIMPLIFY_TOLERANCE,
+        simplify_numpy=numpy is not None,
+        broadcast_tick_ms=BROADCAST_TICK * 1000,
+        worker=WORKER_ID,
+        workers=WORKERS,
+        routing=ROUTING,
+        proxied_clients=sum(1 for info in clients.values() if isinstance(info["outbox"], RemoteOutbox))))
 
 # ---------------- WebSocket handler ----------------
 async def websocket_handler(request):
-    ws = web.WebSocketResponse()
+    # no permessage-deflate: frames are encoded once and shared, and it would compress them again per connection
+    ws = web.WebSocketResponse(compress=False)
     await ws.prepare(request)
 
     client_id = str(uuid.uuid4())
-    clients[client_id] = {"ws": ws, "class_id": None, "role": None, "name": None, "token": None}
-
+    me = clients[client_id] = new_client(client_id, ws, request.transport, Outbox(ws))
     try:
         async for raw in ws:
             if raw.type == WSMsgType.TEXT:
+                # over the limit, a message is dropped before it costs a decode
+                if not me["msg_bucket"].take():
+                    metrics["rate_limited"] += 1
+                    if not me["throttled"]:
+                        me["throttled"] = True
+                        send_json(me, {"type":"error","error":"rate-limited"})
+                    continue
+                me["throttled"] = False
                 try:
-                    data = json.loads(raw.data)
+                    data = decode(raw.data)
                 except Exception:
-                    await send_json(ws, {"type":"error","error":"invalid-json"})
+                    send_json(me, {"type":"error","error":"invalid-json"})
                     continue
-
-                typ = data.get("type")
-
-                # ---------- JOIN ----------
-                if typ == "join":
-                    role = data.get("role")
-                    class_id = data.get("class_id")
-                    if not class_id or class_id not in classes:
-                        await send_json(ws, {"type":"error","error":"invalid-class"}); continue
-                    room = classes[class_id]
-
-                    if role == "teacher":
-                        key = data.get("key")
-                        if key != room.get("teacher_key"):
-                            await send_json(ws, {"type":"error","error":"invalid-teacher-key"}); continue
-                        name = data.get("name") or "Teacher"
-                        clients[client_id].update({"class_id": class_id, "role": "teacher", "name": name, "token": "teacher"})
-                        await send_json(ws, {"type":"joined","id": client_id, "role":"teacher", "class_id": class_id, "pdf_url": f"/files/{room['pdf_filename']}", "teacher_key": room.get("teacher_key"), "name": name})
-                    elif role == "student":
-                        name = data.get("name") or f"Student-{client_id[:6]}"
-                        provided_token = data.get("student_token")
-                        token = None
-                        if provided_token and provided_token in room.get("students", {}):
-                            token = provided_token
-                            room["students"][token]["name"] = name
-                        else:
-                            token = new_student_token()
-                            room.setdefault("students", {})[token] = {"name": name, "allowed": False}
-                        clients[client_id].update({"class_id": class_id, "role": "student", "name": name, "token": token})
-                        await send_json(ws, {"type":"joined", "id": client_id, "role":"student", "class_id": class_id, "pdf_url": f"/files/{room['pdf_filename']}", "student_token": token, "name": name})
-                        save_state()
+                if data.get("type") == "join":
+                    if ROUTING == "affinity":
+                        owner = class_owner(data.get("class_id"))
+                        if owner != WORKER_ID:
+                            leave_class(client_id)
+                            await relay_to_owner(ws, owner, raw.data)
+                            break
                     else:
-                        await send_json(ws, {"type":"error","error":"unknown-role"}); continue
-
-                    # broadcast presence
-                    participants = []
-                    for cid, info in clients.items():
-                        if info.get("class_id") == class_id and info.get("name"):
-                            participants.append({"id": cid, "name": info.get("name"), "role": info.get("role")})
-                    await broadcast_class(class_id, {"type":"presence","clients": participants})
-
-                    # send pending to teacher
-                    if clients[client_id]["role"] == "teacher":
-                        pend = []
-                        for rid, r in room.get("pending", {}).items():
-                            pend.append({"request_id": rid, "name": room["students"].get(r["student_token"], {}).get("name"), "page": r["page"], "note": r.get("note","")})
-                        await send_json(ws, {"type":"pending_list","pending": pend})
-
-                    # send persisted strokes
-                    await send_json(ws, {"type":"init_strokes", "strokes": room.get("strokes", {})})
-
-                    # send annotator status
-                    annot = room.get("current_annotator")
-                    annot_name = None
-                    if annot == "teacher":
-                        annot_name = "Teacher"
-                    elif annot:
-                        annot_name = room.get("students", {}).get(annot, {}).get("name")
-                    await send_json(ws, {"type":"annotator_update", "current_annotator": annot, "annotator_name": annot_name})
+                        route_join(client_id, me, data)
+                if me["owner"] is not None:
+                    # the owner handles it and sends the replies back over the backplane
+                    backplane_send(me["owner"], {"op": "msg", "client": client_id, "from": WORKER_ID}, raw.data.encode("utf-8"))
                     continue
+                await handle_message(client_id, me, data)
+            elif raw.type == WSMsgType.ERROR:
+                print("WS error:", raw)
+    finally:
+        if me["owner"] is not None:
+            backplane_send(me["owner"], {"op": "close", "client": client_id})
+        drop_client(client_id)
+    return ws
 
-                # ---------- REQUEST ANNOTATE ----------
-                if typ == "request_annotate":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id:
-                        await send_json(ws, {"type":"error","error":"not-in-class"}); continue
-                    room = classes[class_id]
-                    student_token = info.get("token")
-                    page = int(data.get("page", 1))
-                    note = data.get("note", "")
-                    reqid = str(uuid.uuid4())
-                    room.setdefault("pending", {})[reqid] = {"student_token": student_token, "page": page, "note": note}
-                    save_state()
-                    await broadcast_class(class_id, {"type":"pending_new", "request_id": reqid, "name": room["students"][student_token]["name"], "page": page, "note": note})
-                    await send_json(ws, {"type":"info", "message":"request_created"})
-                    continue
+def leave_class(client_id):
+    """Take a connection out of its class: end its live strokes and update presence."""
+    info = clients.get(client_id)
+    if not info or not info.get("class_id"):
+        return
+    unindex_client(client_id)
+    cid = info["class_id"]
+    info["class_id"] = info["room"] = None
+    if cid in classes:
+        classes[cid]["_last_active"] = time.monotonic()
+    for live in info["live"].values():
+        broadcast_class(cid, {"type":"stroke_end", "stroke_id": live["stroke_id"], "aborted": True}, where=supports("stream"))
+    info["live"].clear()
+    note_presence(cid, client_id, False)
 
-                # ---------- APPROVE ----------
-                if typ == "approve":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id or info.get("role") != "teacher":
-                        await send_json(ws, {"type":"error","error":"not-teacher"}); continue
-                    room = classes[class_id]
-                    reqid = data.get("request_id")
-                    req = room.get("pending", {}).pop(reqid, None)
-                    if not req:
-                        await send_json(ws, {"type":"error","error":"unknown-request"}); continue
-                    student_token = req["student_token"]
-                    room.setdefault("students", {}).setdefault(student_token, {"name":"Unknown", "allowed": True})
-                    room["students"][student_token]["allowed"] = True
-                    room["current_annotator"] = student_token
-                    room["last_student_annotator"] = student_token
-                    save_state()
-                    for cid, cinfo in clients.items():
-                        if cinfo.get("class_id") == class_id and cinfo.get("token") == student_token:
-                            try:
-                                await cinfo["ws"].send_str(json.dumps({"type":"request_result","result":"approved","page": req["page"]}))
-                            except Exception:
-                                pass
-                    await broadcast_class(class_id, {"type":"annotator_update", "current_annotator": student_token, "annotator_name": room["students"][student_token]["name"]})
-                    await broadcast_class(class_id, {"type":"info", "message": f"{room['students'][student_token]['name']} approved to annotate page {req['page']}."})
-                    continue
+def drop_client(client_id):
+    info = clients.get(client_id)
+    if info is None:
+        return
+    info["outbox"].close()
+    leave_class(client_id)
+    clients.pop(client_id, None)
 
-                # ---------- DENY ----------
-                if typ == "deny":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id or info.get("role") != "teacher":
-                        await send_json(ws, {"type":"error","error":"not-teacher"}); continue
-                    room = classes[class_id]
-                    reqid = data.get("request_id")
-                    req = room.get("pending", {}).pop(reqid, None)
-                    if not req:
-                        await send_json(ws, {"type":"error","error":"unknown-request"}); continue
-                    student_token = req["student_token"]
-                    save_state()
-                    for cid, cinfo in clients.items():
-                        if cinfo.get("class_id") == class_id and cinfo.get("token") == student_token:
-                            try:
-                                await cinfo["ws"].send_str(json.dumps({"type":"request_result","result":"denied","page": req["page"]}))
-                            except Exception:
-                                pass
-                    continue
+async def close_sockets(app):
+    """Close every local connection on shutdown, so that handlers finish now rather than at the shutdown timeout."""
+    await asyncio.gather(*(info["ws"].close(code=WSCloseCode.GOING_AWAY, message=b"server shutdown")
+                           for info in list(clients.values()) if info["ws"] is not None), return_exceptions=True)
 
-                # ---------- REVOKE ----------
-                if typ == "revoke":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id or info.get("role") != "teacher":
-                        await send_json(ws, {"type":"error","error":"not-teacher"}); continue
-                    room = classes[class_id]
-                    sid = data.get("student_token")
-                    if sid:
-                        if room.get("current_annotator") == sid:
-                            room["current_annotator"] = None
-                    else:
-                        room["current_annotator"] = None
-                    save_state()
-                    await broadcast_class(class_id, {"type":"annotator_update", "current_annotator": room.get("current_annotator"), "annotator_name": (room["students"].get(room.get("current_annotator"),{}).get("name") if room.get("current_annotator") else None)})
-                    await broadcast_class(class_id, {"type":"info","message":"Annotation stopped by teacher."})
-                    continue
+# ---------------- Message handlers ----------------
+# type -> (handler, who may send it). Handlers are called as
+# handler(client_id, me, room, data), room being the sender's class (me["room"]);
+# the async ones (join) return an awaitable. Who may send it:
+#   None       anyone, in a class or not (room may be None)
+#   "class"    a client in a class
+#   "teacher"  the teacher of a class
+#   "student"  a student in a class
+HANDLERS = {}
+DENIED = {"class": "not-in-class", "teacher": "not-teacher", "student": "not-student"}
 
-                # ---------- STROKE ----------
-                if typ == "stroke":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id:
-                        await send_json(ws, {"type":"error","error":"not-in-class"}); continue
-                    room = classes[class_id]
-                    role = info.get("role")
-                    if role == "teacher":
-                        author = "teacher"
-                    else:
-                        student_token = info.get("token")
-                        if room.get("students", {}).get(student_token, {}).get("allowed") != True or room.get("current_annotator") != student_token:
-                            await send_json(ws, {"type":"error","error":"not-allowed-to-annotate"}); continue
-                        author = student_token
-                        room["last_student_annotator"] = student_token
-                    stroke = data.get("stroke")
-                    if not stroke:
-                        await send_json(ws, {"type":"error","error":"missing-stroke"}); continue
-                    page = str(stroke.get("page", "1"))
-                    entry = {"author": author, "color": stroke.get("color", "#ff0000"), "width": stroke.get("width", 3), "points": stroke.get("points", [])}
-                    room.setdefault("strokes", {}).setdefault(page, []).append(entry)
-                    save_state()
-                    await broadcast_class(class_id, {"type":"apply_stroke", "stroke": {"page": page, "author": author, "color": entry["color"], "width": entry["width"], "points": entry["points"]}})
-                    continue
+def handles(typ, allowed=None):
+    def register(handler):
+        HANDLERS[typ] = (handler, allowed)
+        return handler
+    return register
 
-                # ---------- CLEAR MY ANNOTATIONS (student) ----------
-                if typ == "clear_my_annotations":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id or info.get("role") != "student":
-                        await send_json(ws, {"type":"error","error":"not-student"}); continue
-                    room = classes[class_id]
-                    my_token = info.get("token")
-                    new_strokes = {}
-                    for page, lst in room.get("strokes", {}).items():
-                        filtered = [s for s in lst if s.get("author") != my_token]
-                        if filtered:
-                            new_strokes[page] = filtered
-                    room["strokes"] = new_strokes
-                    # if last/current annotator was this student, clear those references
-                    if room.get("last_student_annotator") == my_token:
-                        room["last_student_annotator"] = None
-                    if room.get("current_annotator") == my_token:
-                        room["current_annotator"] = None
-                    save_state()
-                    await broadcast_class(class_id, {"type":"init_strokes","strokes": room.get("strokes", {})})
-                    await broadcast_class(class_id, {"type":"annotator_update","current_annotator": room.get("current_annotator"), "annotator_name": (room["students"].get(room.get("current_annotator"),{}).get("name") if room.get("current_annotator") else None)})
-                    await send_json(ws, {"type":"info","message":"Your annotations cleared."})
-                    continue
+async def handle_message(client_id, me, data):
+    """Act on one message from a client of a class this worker owns (local or proxied)."""
+    entry = HANDLERS.get(data.get("type"))
+    if entry is None:
+        send_json(me, {"type":"error","error":"unknown-type"}); return
+    handler, allowed = entry
+    room = me["room"]
+    if allowed is not None and (room is None or (allowed != "class" and me["role"] != allowed)):
+        send_json(me, {"type":"error","error": DENIED[allowed]}); return
+    result = handler(client_id, me, room, data)
+    if result is not None:
+        await result
 
-                # ---------- CLEAR TEACHER ANNOTATIONS (teacher) ----------
-                if typ == "clear_teacher_annotations":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id or info.get("role") != "teacher":
-                        await send_json(ws, {"type":"error","error":"not-teacher"}); continue
-                    room = classes[class_id]
-                    new_strokes = {}
-                    for page, lst in room.get("strokes", {}).items():
-                        filtered = [s for s in lst if s.get("author") != "teacher"]
-                        if filtered:
-                            new_strokes[page] = filtered
-                    room["strokes"] = new_strokes
-                    save_state()
-                    await broadcast_class(class_id, {"type":"init_strokes","strokes": room.get("strokes", {})})
-                    await broadcast_class(class_id, {"type":"info","message":"Teacher annotations cleared (students preserved)."})
-                    continue
+def other_streamers(me):
+    """Everyone else in the class who negotiated "stream"."""
+    return lambda info: info is not me and "stream" in info["features"]
 
-                # ---------- CLEAR STUDENT ANNOTATIONS (last student) ----------
-                if typ == "clear_student_annotations":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id or info.get("role") != "teacher":
-                        await send_json(ws, {"type":"error","error":"not-teacher"}); continue
-                    room = classes[class_id]
-                    target = room.get("last_student_annotator")
-                    if not target:
-                        await send_json(ws, {"type":"info","message":"No student annotations to clear."}); continue
-                    new_strokes = {}
-                    for page, lst in room.get("strokes", {}).items():
-                        filtered = [s for s in lst if s.get("author") != target]
-                        if filtered:
-                            new_strokes[page] = filtered
-                    room["strokes"] = new_strokes
-                    room["last_student_annotator"] = None
-                    if room.get("current_annotator") == target:
-                        room["current_annotator"] = None
-                    save_state()
-                    await broadcast_class(class_id, {"type":"init_strokes","strokes": room.get("strokes", {})})
-                    await broadcast_class(class_id, {"type":"annotator_update","current_annotator": room.get("current_annotator"), "annotator_name": (room["students"].get(room.get("current_annotator"),{}).get("name") if room.get("current_annotator") else None)})
-                    await broadcast_class(class_id, {"type":"info","message":"Cleared annotations made by last student annotator (teacher annotations preserved)."})
-                    continue
+def annotator_update(room):
+    annot = room.get("current_annotator")
+    return {"type":"annotator_update", "current_annotator": annot, "annotator_name": (room["students"].get(annot, {}).get("name") if annot else None)}
 
-                # ---------- CLEAR ALL ----------
-                if typ == "clear_annotations":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id or info.get("role") != "teacher":
-                        await send_json(ws, {"type":"error","error":"not-teacher"}); continue
-                    room = classes[class_id]
-                    room["strokes"] = {}
-                    room["last_student_annotator"] = None
-                    room["current_annotator"] = None
-                    save_state()
-                    await broadcast_class(class_id, {"type":"clear_annotations"})
-                    await broadcast_class(class_id, {"type":"annotator_update","current_annotator": None, "annotator_name": None})
-                    continue
+# ---------- JOIN ----------
+@handles("join")
+async def on_join(client_id, me, room, data):
+    role = data.get("role")
+    class_id = data.get("class_id")
+    room = await get_room(class_id)
+    if room is None:
+        send_json(me, {"type":"error","error":"invalid-class"}); return
+    # the snapshot below includes held strokes; don't send them again
+    flush_strokes(class_id, room)
+    requested = data.get("features")
+    features = SERVER_FEATURES.intersection(requested) if isinstance(requested, list) else set()
+    if "ids" not in features:
+        # missed removals are replayed as remove_strokes; batched strokes are deduplicated by id
+        features.discard("resume")
+        features.discard("batch")
+    missed = missed_deltas(room, data.get("last_seq")) if "resume" in features else None
 
-                # ---------- GOTO PAGE ----------
-                if typ == "goto_page":
-                    info = clients[client_id]
-                    class_id = info.get("class_id")
-                    if not class_id or info.get("role") != "teacher":
-                        await send_json(ws, {"type":"error","error":"not-teacher"}); continue
-                    page = int(data.get("page", 1))
-                    await broadcast_class(class_id, {"type":"goto_page", "page": page})
-                    continue
+    if role == "teacher":
+        key = data.get("key")
+        if key != room.get("teacher_key"):
+            send_json(me, {"type":"error","error":"invalid-teacher-key"}); return
+        name = data.get("name") or "Teacher"
+        if me["class_id"] != class_id:
+            # switching classes: the old one sees this client leave
+            leave_class(client_id)
+        unindex_client(client_id)
+        me.update({"class_id": class_id, "room": room, "role": "teacher", "name": name, "token": "teacher", "features": features, "codec": "q16" if "q16" in features else "json"})
+        index_client(client_id)
+        send_json(me, {"type":"joined","id": client_id, "role":"teacher", "class_id": class_id, "pdf_url": f"/files/{room['pdf_filename']}", "pages_url": pages_url(room), "teacher_key": room.get("teacher_key"), "name": name, "features": sorted(features), "resumed": missed is not None})
+    elif role == "student":
+        name = data.get("name") or f"Student-{client_id[:6]}"
+        provided_token = data.get("student_token")
+        token = None
+        if provided_token and provided_token in room.get("students", {}):
+            token = provided_token
+            room["students"][token]["name"] = name
+        else:
+            token = new_student_token()
+            room.setdefault("students", {})[token] = {"name": name, "allowed": False}
+        if me["class_id"] != class_id:
+            leave_class(client_id)
+        unindex_client(client_id)
+        me.update({"class_id": class_id, "room": room, "role": "student", "name": name, "token": token, "features": features, "codec": "q16" if "q16" in features else "json"})
+        index_client(client_id)
+        send_json(me, {"type":"joined", "id": client_id, "role":"student", "class_id": class_id, "pdf_url": f"/files/{room['pdf_filename']}", "pages_url": pages_url(room), "student_token": token, "name": name, "features": sorted(features), "resumed": missed is not None})
+        journal_meta(class_id)
+    else:
+        send_json(me, {"type":"error","error":"unknown-role"}); return
 
-                await send_json(ws, {"type":"error","error":"unknown-type"})
-            elif raw.type == WSMsgType.ERROR:
-                print("WS error:", raw)
-    finally:
-        info = clients.pop(client_id, None)
-        if info and info.get("class_id"):
-            cid = info["class_id"]
-            participants = []
-            for ccid, cinfo in clients.items():
-                if cinfo.get("class_id") == cid and cinfo.get("name"):
-                    participants.append({"id": ccid, "name": cinfo.get("name"), "role": cinfo.get("role")})
-            await broadcast_class(cid, {"type":"presence","clients": participants})
-    return ws
+    # the whole list for the joiner only; the rest of the class hears of it with the next flush_presence
+    send_json(me, {"type":"presence","clients": presence_list(class_id)})
+    note_presence(class_id, client_id, True)
+
+    # send pending to teacher
+    if me["role"] == "teacher":
+        pend = []
+        for rid, r in room.get("pending", {}).items():
+            pend.append({"request_id": rid, "name": room["students"].get(r["student_token"], {}).get("name"), "page": r["page"], "note": r.get("note","")})
+        send_json(me, {"type":"pending_list","pending": pend})
+
+    if missed is not None:
+        # the client kept its strokes; bring it up to date
+        metrics["resumes"] += 1
+        for delta in missed:
+            send_json(me, delta)
+        if "stream" in features:
+            for live in live_strokes(class_id):
+                send_json(me, dict(live, type="stroke_begin"))
+    else:
+        if "resume" in features and data.get("last_seq") is not None:
+            metrics["resume_misses"] += 1
+        # send persisted strokes (just the page in view for "paged" clients)
+        send_json(me, init_strokes_payload(me, room, page_key(data.get("page"))))
+
+    # send annotator status
+    annot = room.get("current_annotator")
+    annot_name = None
+    if annot == "teacher":
+        annot_name = "Teacher"
+    elif annot:
+        annot_name = room.get("students", {}).get(annot, {}).get("name")
+    send_json(me, {"type":"annotator_update", "current_annotator": annot, "annotator_name": annot_name})
+
+# ---------- REQUEST ANNOTATE ----------
+@handles("request_annotate", "class")
+def on_request_annotate(client_id, me, room, data):
+    class_id = me["class_id"]
+    student_token = me["token"]
+    page = page_key(data.get("page", 1))
+    if page is None:
+        send_json(me, {"type":"error","error":"bad-page"}); return
+    page = int(page)
+    note = data.get("note", "")
+    reqid = str(uuid.uuid4())
+    room.setdefault("pending", {})[reqid] = {"student_token": student_token, "page": page, "note": note}
+    journal_meta(class_id)
+    broadcast_class(class_id, {"type":"pending_new", "request_id": reqid, "name": room["students"][student_token]["name"], "page": page, "note": note})
+    send_json(me, {"type":"info", "message":"request_created"})
+
+# ---------- APPROVE ----------
+@handles("approve", "teacher")
+def on_approve(client_id, me, room, data):
+    class_id = me["class_id"]
+    reqid = data.get("request_id")
+    req = room.get("pending", {}).pop(reqid, None)
+    if not req:
+        send_json(me, {"type":"error","error":"unknown-request"}); return
+    student_token = req["student_token"]
+    room.setdefault("students", {}).setdefault(student_token, {"name":"Unknown", "allowed": True})
+    room["students"][student_token]["allowed"] = True
+    room["current_annotator"] = student_token
+    room["last_student_annotator"] = student_token
+    journal_meta(class_id)
+    send_to_token(class_id, student_token, {"type":"request_result","result":"approved","page": req["page"]})
+    broadcast_class(class_id, {"type":"annotator_update", "current_annotator": student_token, "annotator_name": room["students"][student_token]["name"]})
+    broadcast_class(class_id, {"type":"info", "message": f"{room['students'][student_token]['name']} approved to annotate page {req['page']}."})
+
+# ---------- DENY ----------
+@handles("deny", "teacher")
+def on_deny(client_id, me, room, data):
+    class_id = me["class_id"]
+    reqid = data.get("request_id")
+    req = room.get("pending", {}).pop(reqid, None)
+    if not req:
+        send_json(me, {"type":"error","error":"unknown-request"}); return
+    journal_meta(class_id)
+    send_to_token(class_id, req["student_token"], {"type":"request_result","result":"denied","page": req["page"]})
+
+# ---------- REVOKE ----------
+@handles("revoke", "teacher")
+def on_revoke(client_id, me, room, data):
+    class_id = me["class_id"]
+    sid = data.get("student_token")
+    if sid:
+        if room.get("current_annotator") == sid:
+            room["current_annotator"] = None
+    else:
+        room["current_annotator"] = None
+    journal_meta(class_id)
+    broadcast_class(class_id, annotator_update(room))
+    broadcast_class(class_id, {"type":"info","message":"Annotation stopped by teacher."})
+
+# ---------- STROKE ----------
+@handles("stroke", "class")
+def on_stroke(client_id, me, room, data):
+    author = stroke_author(me, room)
+    if author is None:
+        send_json(me, {"type":"error","error":"not-allowed-to-annotate"}); return
+    stroke = data.get("stroke")
+    if not stroke:
+        send_json(me, {"type":"error","error":"missing-stroke"}); return
+    points = take_points(me, stroke)
+    if points is None:
+        return
+    page = page_key(stroke.get("page", 1))
+    if page is None:
+        send_json(me, {"type":"error","error":"bad-page"}); return
+    class_id = me["class_id"]
+    entry = {"author": author, "color": stroke.get("color", "#ff0000"), "width": stroke.get("width", 3), "points": points}
+    entry = commit_stroke(class_id, room, page, entry)
+    if "ids" in me["features"]:
+        # the sender already drew it; it only needs the id
+        send_json(me, with_seq(room, {"type":"stroke_ack", "stroke_id": stroke.get("stroke_id"), "id": entry["id"]}))
+        hold_stroke(class_id, room, {"type":"apply_stroke", "stroke": dict(entry, page=page)}, where=lambda info: info is not me)
+    else:
+        hold_stroke(class_id, room, {"type":"apply_stroke", "stroke": dict(entry, page=page)})
+
+# ---------- STREAMED STROKE ----------
+# deltas are relayed as they arrive; only stroke_end persists
+@handles("stroke_begin", "class")
+def on_stroke_begin(client_id, me, room, data):
+    author = stroke_author(me, room)
+    if author is None:
+        send_json(me, {"type":"error","error":"not-allowed-to-annotate"}); return
+    sid = data.get("stroke_id")
+    if not isinstance(sid, (str, int)) or sid in me["live"] or len(me["live"]) >= MAX_LIVE_STROKES:
+        send_json(me, {"type":"error","error":"bad-stroke-id"}); return
+    page = page_key(data.get("page", 1))
+    if page is None:
+        send_json(me, {"type":"error","error":"bad-page"}); return
+    points = take_points(me, data)
+    if points is None:
+        return
+    live = {"stroke_id": f"{client_id}:{sid}", "page": page, "author": author,
+            "color": data.get("color", "#ff0000"), "width": data.get("width", 3), "points": list(points)}
+    me["live"][sid] = live
+    broadcast_class(me["class_id"], dict(live, type="stroke_begin"), where=other_streamers(me))
+
+def take_points(me, data, held=0):
+    """Points of an incoming stroke message, or None (the client told why) when they break its limits."""
+    packed = data.get("p")
+    # no point packs into more than 8 base64 characters, so this is known before decoding
+    if isinstance(packed, str) and len(packed) > (MAX_STROKE_POINTS - held) * 8:
+        points = None
+    else:
+        points = stroke_points_arg(data)
+    if points is None or held + len(points) > MAX_STROKE_POINTS:
+        metrics["strokes_too_large"] += 1
+        send_json(me, {"type":"error","error":"stroke-too-large"}); return None
+    if not me["point_bucket"].take(len(points)):
+        metrics["rate_limited"] += 1
+        send_json(me, {"type":"error","error":"rate-limited"}); return None
+    return points
+
+def abort_live_stroke(me, sid):
+    live = me["live"].pop(sid)
+    broadcast_class(me["class_id"], {"type":"stroke_end", "stroke_id": live["stroke_id"], "aborted": True}, where=other_streamers(me))
+
+# live strokes are dropped on leaving a class, so these need no class check of their own
+@handles("stroke_points")
+def on_stroke_points(client_id, me, room, data):
+    live = me["live"].get(data.get("stroke_id"))
+    if live is None:
+        send_json(me, {"type":"error","error":"unknown-stroke"}); return
+    points = take_points(me, data, len(live["points"]))
+    if points is None:
+        abort_live_stroke(me, data.get("stroke_id"))
+        return
+    live["points"].extend(points)
+    broadcast_class(me["class_id"], {"type":"stroke_points", "stroke_id": live["stroke_id"], "points": points}, where=other_streamers(me))
+
+@handles("stroke_end")
+def on_stroke_end(client_id, me, room, data):
+    live = me["live"].get(data.get("stroke_id"))
+    if live is None:
+        send_json(me, {"type":"error","error":"unknown-stroke"}); return
+    tail = take_points(me, data, len(live["points"]))
+    if tail is None:
+        abort_live_stroke(me, data.get("stroke_id"))
+        return
+    del me["live"][data.get("stroke_id")]
+    class_id = me["class_id"]
+    live["points"].extend(tail)
+    if stroke_author(me, room) != live["author"] or not live["points"]:
+        # annotation rights were revoked mid-stroke
+        broadcast_class(class_id, {"type":"stroke_end", "stroke_id": live["stroke_id"], "aborted": True}, where=other_streamers(me))
+        return
+    entry = {"author": live["author"], "color": live["color"], "width": live["width"], "points": live["points"]}
+    entry = commit_stroke(class_id, room, live["page"], entry)
+    if "ids" in me["features"]:
+        send_json(me, with_seq(room, {"type":"stroke_ack", "stroke_id": data.get("stroke_id"), "id": entry["id"]}))
+    broadcast_class(class_id, with_seq(room, {"type":"stroke_end", "stroke_id": live["stroke_id"], "id": entry["id"], "points": tail}), where=other_streamers(me))
+    hold_stroke(class_id, room, {"type":"apply_stroke", "stroke": dict(entry, page=live["page"])}, where=lacks("stream"))
+
+# ---------- UNDO / REDO (own strokes) ----------
+@handles("undo_stroke", "class")
+def on_undo_stroke(client_id, me, room, data):
+    author = stroke_author(me, room)
+    if author is None:
+        send_json(me, {"type":"error","error":"not-allowed-to-annotate"}); return
+    undone = undo_stroke(me["class_id"], room, author)
+    if undone is None:
+        send_json(me, {"type":"info","message":"Nothing to undo."}); return
+    broadcast_removal(me["class_id"], room, [undone[1]["id"]])
+
+@handles("redo_stroke", "class")
+def on_redo_stroke(client_id, me, room, data):
+    author = stroke_author(me, room)
+    if author is None:
+        send_json(me, {"type":"error","error":"not-allowed-to-annotate"}); return
+    redone = redo_stroke(me["class_id"], room, author)
+    if redone is None:
+        send_json(me, {"type":"info","message":"Nothing to redo."}); return
+    page, entry = redone
+    hold_stroke(me["class_id"], room, {"type":"apply_stroke", "stroke": dict(entry, page=page)})
+
+# ---------- PAGE STROKES ("paged" clients) ----------
+@handles("get_page_strokes", "class")
+def on_get_page_strokes(client_id, me, room, data):
+    page = page_key(data.get("page", 1))
+    if page is None:
+        send_json(me, {"type":"error","error":"bad-page"}); return
+    send_json(me, {"type":"page_strokes", "page": page, "strokes": list(room["strokes"].get(page, {}).values())})
+
+# ---------- CLEAR MY ANNOTATIONS (student) ----------
+@handles("clear_my_annotations", "student")
+def on_clear_my_annotations(client_id, me, room, data):
+    class_id = me["class_id"]
+    my_token = me["token"]
+    removed = remove_author_strokes(room, my_token)
+    if removed:
+        journal_clear(class_id, my_token)
+    # if last/current annotator was this student, clear those references
+    if room.get("last_student_annotator") == my_token:
+        room["last_student_annotator"] = None
+    if room.get("current_annotator") == my_token:
+        room["current_annotator"] = None
+    journal_meta(class_id)
+    broadcast_removal(class_id, room, removed)
+    broadcast_class(class_id, annotator_update(room))
+    send_json(me, {"type":"info","message":"Your annotations cleared."})
+
+# ---------- CLEAR TEACHER ANNOTATIONS (teacher) ----------
+@handles("clear_teacher_annotations", "teacher")
+def on_clear_teacher_annotations(client_id, me, room, data):
+    class_id = me["class_id"]
+    removed = remove_author_strokes(room, "teacher")
+    if removed:
+        journal_clear(class_id, "teacher")
+    broadcast_removal(class_id, room, removed)
+    broadcast_class(class_id, {"type":"info","message":"Teacher annotations cleared (students preserved)."})
+
+# ---------- CLEAR STUDENT ANNOTATIONS (last student) ----------
+@handles("clear_student_annotations", "teacher")
+def on_clear_student_annotations(client_id, me, room, data):
+    class_id = me["class_id"]
+    target = room.get("last_student_annotator")
+    if not target:
+        send_json(me, {"type":"info","message":"No student annotations to clear."}); return
+    removed = remove_author_strokes(room, target)
+    if removed:
+        journal_clear(class_id, target)
+    room["last_student_annotator"] = None
+    if room.get("current_annotator") == target:
+        room["current_annotator"] = None
+    journal_meta(class_id)
+    broadcast_removal(class_id, room, removed)
+    broadcast_class(class_id, annotator_update(room))
+    broadcast_class(class_id, {"type":"info","message":"Cleared annotations made by last student annotator (teacher annotations preserved)."})
+
+# ---------- CLEAR ALL ----------
+@handles("clear_annotations", "teacher")
+def on_clear_annotations(client_id, me, room, data):
+    class_id = me["class_id"]
+    clear_strokes(room)
+    room["last_student_annotator"] = None
+    room["current_annotator"] = None
+    journal_clear(class_id)
+    journal_meta(class_id)
+    push_delta(class_id, room, {"type":"clear_annotations"})
+    broadcast_class(class_id, {"type":"annotator_update","current_annotator": None, "annotator_name": None})
+
+# ---------- GOTO PAGE ----------
+@handles("goto_page", "teacher")
+def on_goto_page(client_id, me, room, data):
+    page = page_key(data.get("page", 1))
+    if page is None:
+        send_json(me, {"type":"error","error":"bad-page"}); return
+    # late joiners get this page's strokes first
+    room["_current_page"] = page
+    broadcast_class(me["class_id"], {"type":"goto_page", "page": int(page)})
+    prefetch_pages(room, int(page))
 
 # ---------------- App setup ----------------
-load_state()
 app = web.Application()
+app.on_response_prepare.append(set_content_etag)
+app.on_startup.append(start_persistence)
+app.on_startup.append(start_backplane)
+app.on_startup.append(start_upload_sweep)
+app.on_startup.append(start_raster)
+app.on_shutdown.append(close_sockets)
+# once their handlers are done; the backplane goes before the final flush, as its messages change rooms too
+app.on_cleanup.append(stop_backplane)
+app.on_cleanup.append(stop_affinity)
+app.on_cleanup.append(stop_persistence)
+app.on_cleanup.append(stop_raster)
 app.router.add_get("/", index)
 app.router.add_post("/upload", upload_pdf)
 app.router.add_get("/ws", websocket_handler)
 app.router.add_get("/files/{filename}", serve_file)
+app.router.add_get("/export/{class_id}.pdf", export_class_pdf)
+app.router.add_get("/export/{class_id}/{page}.png", export_page_png)
+if RASTER_PAGES:
+    app.router.add_get("/pages/{doc}", serve_doc_info)
+    app.router.add_get("/pages/{doc}/{page}", serve_page)
+app.router.add_get("/metrics", get_metrics)
 app.router.add_static("/static/", path=os.path.join(BASE_DIR, "static"), show_index=False)
 app.router.add_static("/", os.path.join(BASE_DIR, "static"), show_index=False)
 
 if __name__ == "__main__":
-    print("Server running on http://0.0.0.0:8080")
-    web.run_app(app, host="0.0.0.0", port=8080)
+    # before any worker starts, so the split happens once; importing app leaves the disk alone
+    load_state()
+    if WORKERS > 1 and "WORKER_ID" not in os.environ:
+        print(f"Server running on http://0.0.0.0:{PORT} ({WORKERS} workers)")
+        try:
+            asyncio.run(supervise())
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(f"Server running on http://0.0.0.0:{PORT}")
+        # with affinity routing, the other workers reach this one's classes through its socket
+        path = worker_socket(WORKER_ID) if WORKERS > 1 and ROUTING == "affinity" else None
+        web.run_app(app, host="0.0.0.0", port=PORT, path=path, reuse_port=WORKERS > 1)
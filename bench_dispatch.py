@@ -0,0 +1,109 @@
+# bench_dispatch.py
+"""
+Microbenchmark of the WebSocket message path: decode + handle_message, in one
+process on one core, with no sockets (frames go to a sink outbox).
+
+Run:
+    python bench_dispatch.py                 # default mix
+    python bench_dispatch.py --students 30 --legacy 10 --rounds 2000
+
+Prints messages per second for each message type and for the whole mix.
+Needs the same packages as app.py; state/ is left untouched (nothing is
+flushed, and importing app does not prepare it).
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+# one client sends everything here, far past what the per-connection limits allow
+os.environ.setdefault("POINT_RATE", "1e12")
+os.environ.setdefault("MSG_RATE", "1e12")
+import app
+
+
+class SinkOutbox:
+    """Outbox that accepts every frame and keeps none."""
+    frames = ()
+
+    def push(self, frame):
+        return True
+
+    def drop(self, kinds):
+        return 0
+
+    def close(self):
+        pass
+
+
+def stroke_points(n, offset=0.0):
+    return [{"x": 0.1 + offset + i * 0.003, "y": 0.2 + (i % 7) * 0.004} for i in range(n)]
+
+
+def message_mix():
+    """(type, raw text) pairs of one round, roughly as a teacher sends them while drawing."""
+    msgs = [{"type": "stroke", "stroke": {"page": 1, "color": "#ff0000", "width": 3, "points": stroke_points(24)}}]
+    msgs.append({"type": "stroke_begin", "stroke_id": 1, "page": 1, "color": "#0000ff", "width": 2, "points": stroke_points(4)})
+    msgs += [{"type": "stroke_points", "stroke_id": 1, "points": stroke_points(4, 0.02 * k)} for k in range(1, 7)]
+    msgs.append({"type": "stroke_end", "stroke_id": 1, "points": stroke_points(2, 0.2)})
+    msgs.append({"type": "get_page_strokes", "page": 2})
+    msgs.append({"type": "goto_page", "page": 1})
+    msgs.append({"type": "undo_stroke"})
+    msgs.append({"type": "redo_stroke"})
+    return [(m["type"], json.dumps(m)) for m in msgs]
+
+
+async def setup(students, legacy):
+    class_id = "bench"
+    app.classes[class_id] = {"teacher_key": "BENCH1", "pdf_filename": "bench.pdf", "students": {}, "pending": {},
+                             "last_student_annotator": None, "current_annotator": None, "_last_active": time.monotonic()}
+    app.hydrate_room(app.classes[class_id])
+    features = ["stream", "ids", "q16", "resume", "batch"]
+    teacher = str(len(app.clients))
+    app.clients[teacher] = app.new_client(teacher, None, None, SinkOutbox())
+    await app.handle_message(teacher, app.clients[teacher], {"type": "join", "role": "teacher", "class_id": class_id, "key": "BENCH1", "features": features})
+    for i in range(students):
+        cid = f"s{i}"
+        app.clients[cid] = app.new_client(cid, None, None, SinkOutbox())
+        # older clients get whole-document resyncs on undo, which dwarf everything else
+        await app.handle_message(cid, app.clients[cid], {"type": "join", "role": "student", "class_id": class_id, "name": cid,
+                                                         "features": [] if i < legacy else features})
+    return class_id, teacher
+
+
+async def run(args):
+    class_id, teacher = await setup(args.students, args.legacy)
+    me = app.clients[teacher]
+    mix = message_mix()
+    totals = {typ: 0.0 for typ, _ in mix}
+    counts = dict.fromkeys(totals, 0)
+    clock = time.perf_counter
+    start = clock()
+    for r in range(args.rounds):
+        for typ, raw in mix:
+            t = clock()
+            await app.handle_message(teacher, me, app.decode(raw))
+            totals[typ] += clock() - t
+            counts[typ] += 1
+        if r % 100 == 99:
+            # keep the room and the unflushed journal from growing without bound
+            await app.handle_message(teacher, me, {"type": "clear_annotations"})
+            app.pending_lines.clear()
+    elapsed = clock() - start
+    print(f"{args.students} students ({args.legacy} legacy), {args.rounds} rounds of {len(mix)} messages")
+    for typ in totals:
+        print(f"  {typ:18} {counts[typ] / totals[typ]:>12,.0f} msg/s")
+    print(f"  {'mix':18} {args.rounds * len(mix) / elapsed:>12,.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--students", type=int, default=4)
+    parser.add_argument("--legacy", type=int, default=0, help="students joining without protocol features")
+    parser.add_argument("--rounds", type=int, default=5000)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,486 @@
+# bench_load.py
+"""
+Load generator for the WebSocket protocol: simulated teachers and students
+talking to app.py over real local sockets, as browsers running static/app.js would.
+
+Run:
+    python bench_load.py --spawn                          # a scratch server on --port, removed afterwards
+    python bench_load.py --spawn --classes 4 --students 60 --out before.json
+    python bench_load.py --spawn --out after.json --baseline before.json
+    python bench_load.py --url http://127.0.0.1:8080 --pid 1234   # a server you started
+    BROADCAST_TICK_MS=33 python bench_load.py --spawn --features ids,batch
+
+Phases, in this order:
+    join   the teachers join, then every student of every class within --storm seconds
+    draw   teachers (and --student-drawers approved students per class) draw streamed
+           strokes at pointer rate for --duration seconds, then finish the strokes under
+           way; every --clear-every seconds each teacher clears its class
+    churn  drawing goes on while students drop and reconnect (resuming from their last seq)
+           at --churn reconnects per second
+
+Each phase reports messages sent and frames received per second; p50/p99 join latency
+(join to joined) and stroke fan-out latency (the drawer sending stroke_end, or "stroke"
+without the stream feature, to each other client seeing the stroke); the server's CPU and
+peak RSS, read from /proc for its process and its direct children (Linux); how the
+/metrics counters of the worker answering them moved; and this process's own CPU. Near
+100% the load generator, not the server, is the bottleneck: lower the load or split it.
+
+--spawn runs a copy of app.py and static/ in a temporary directory, so state/ and
+uploads/ are left alone; it passes its environment on (PORT aside). --out saves the
+results as JSON, and --baseline prints every figure next to the one in a saved run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# what static/app.js asks for with every join
+FEATURES = "stream,q16,paged,ids,resume,batch,presence"
+# static/app.js sends the points of the stroke being drawn every 40 ms; ~100 Hz pointer events
+STREAM_INTERVAL = 0.04
+POINTS_PER_MESSAGE = 4
+# a minimal one-page PDF, uploaded for every class (and stored once)
+PDF = (b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+       b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\ntrailer<</Root 1 0 R>>\n%%EOF\n")
+
+clock = time.perf_counter
+# /metrics fields that are levels rather than counters; reported as they are at the end of a phase
+GAUGES = {"connections", "classes_loaded", "outbox_depth_max", "outbox_depth_total", "outbox_limit",
+          "worker", "workers", "proxied_clients", "broadcast_tick_ms", "simplify_tolerance"}
+
+
+class Stats:
+    """Counters and latency samples of one phase."""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.errors = {}
+        # seconds from join to joined
+        self.joins = []
+        # (class id, server stroke id) -> clock() when its drawer finished it; filled from stroke_ack
+        self.ends = {}
+        # ((class id, server stroke id), clock(), when the client joined) for every other client seeing a stroke
+        self.seen = []
+
+    def fanout(self):
+        # strokes replayed to a client resuming after them are not fan-out
+        return [t - self.ends[key] for key, t, since in self.seen if key in self.ends and self.ends[key] >= since]
+
+
+# the phase being measured; clients count into whichever this is
+stats = Stats()
+
+
+class Client:
+    """One simulated browser tab: a WebSocket, its join message, and what the server told it."""
+
+    def __init__(self, session, url, join, drawer=False):
+        self.session = session
+        self.url = url
+        self.join = join
+        self.drawer = drawer
+        self.ws = None
+        self.reader = None
+        self.joined = None
+        self.token = None
+        self.last_seq = None
+        self.since = None
+        self.features = ()
+        self.allowed = join["role"] == "teacher"
+        self.next_stroke = 1
+        # own stroke_id -> clock() of its stroke_end, until stroke_ack gives the server id
+        self.finished = {}
+        self.busy = False
+
+    async def connect(self):
+        # uncompressed, as the server sends it to browsers too
+        self.ws = await self.session.ws_connect(self.url, max_msg_size=0, compress=0)
+        self.joined = asyncio.get_running_loop().create_future()
+        self.reader = asyncio.ensure_future(self.read())
+        msg = dict(self.join)
+        if self.token is not None:
+            msg["student_token"] = self.token
+        if self.last_seq is not None:
+            msg["last_seq"] = self.last_seq
+        start = clock()
+        await self.send(msg)
+        await self.joined
+        stats.joins.append(self.since - start)
+
+    async def close(self):
+        await self.ws.close()
+        await self.reader
+
+    async def reconnect(self):
+        self.busy = True
+        try:
+            await self.close()
+            await self.connect()
+        finally:
+            self.busy = False
+
+    async def send(self, msg):
+        await self.ws.send_str(json.dumps(msg))
+        stats.sent += 1
+
+    async def read(self):
+        async for raw in self.ws:
+            if raw.type == aiohttp.WSMsgType.TEXT:
+                now = clock()
+                stats.received += 1
+                self.on_message(json.loads(raw.data), now)
+
+    def on_message(self, msg, now):
+        typ = msg.get("type")
+        class_id = self.join["class_id"]
+        if isinstance(msg.get("seq"), int):
+            self.last_seq = msg["seq"]
+        if typ == "stroke_end" and "id" in msg:
+            stats.seen.append(((class_id, msg["id"]), now, self.since))
+        elif typ == "apply_stroke":
+            stats.seen.append(((class_id, msg["stroke"].get("id")), now, self.since))
+        elif typ == "apply_strokes":
+            stats.seen.extend(((class_id, st.get("id")), now, self.since) for st in msg["strokes"])
+        elif typ == "stroke_ack":
+            finished = self.finished.pop(msg.get("stroke_id"), None)
+            if finished is not None:
+                stats.ends[class_id, msg["id"]] = finished
+        elif typ == "joined":
+            self.token = msg.get("student_token", self.token)
+            self.features = msg.get("features", [])
+            # any replay of what was missed follows, in this same reader
+            self.since = now
+            if not self.joined.done():
+                self.joined.set_result(msg)
+        elif typ == "pending_new" and self.join["role"] == "teacher":
+            asyncio.ensure_future(self.send({"type": "approve", "request_id": msg["request_id"]}))
+        elif typ == "annotator_update" and self.join["role"] == "student":
+            self.allowed = msg.get("current_annotator") == self.token
+            if self.drawer and not self.allowed:
+                # joining tells who annotates, and a clear revokes the student annotator; ask (again)
+                asyncio.ensure_future(self.send({"type": "request_annotate", "page": 1, "note": "bench"}))
+        elif typ == "error":
+            stats.errors[msg.get("error")] = stats.errors.get(msg.get("error"), 0) + 1
+
+    async def draw(self, until, rng):
+        """Strokes of 0.5-1.5 s at pointer rate, a short pause after each, until the clock passes until."""
+        x, y = rng.random(), rng.random()
+
+        def chunk(n=POINTS_PER_MESSAGE):
+            nonlocal x, y
+            points = []
+            for _ in range(n):
+                x = min(1.0, max(0.0, x + rng.uniform(-0.004, 0.006)))
+                y = min(1.0, max(0.0, y + rng.uniform(-0.004, 0.004)))
+                points.append({"x": round(x, 5), "y": round(y, 5)})
+            return points
+
+        while clock() < until:
+            if not self.allowed:
+                await asyncio.sleep(0.1)
+                continue
+            sid = self.next_stroke
+            self.next_stroke += 1
+            steps = rng.randint(12, 38)
+            if "stream" in self.features:
+                await self.send({"type": "stroke_begin", "stroke_id": sid, "page": 1, "color": "#ff0000", "width": 3, "points": chunk()})
+                for _ in range(steps):
+                    await asyncio.sleep(STREAM_INTERVAL)
+                    await self.send({"type": "stroke_points", "stroke_id": sid, "points": chunk()})
+                self.finished[sid] = clock()
+                await self.send({"type": "stroke_end", "stroke_id": sid, "points": chunk(1)})
+            else:
+                await asyncio.sleep(steps * STREAM_INTERVAL)
+                self.finished[sid] = clock()
+                await self.send({"type": "stroke", "stroke": {"stroke_id": sid, "page": 1, "color": "#ff0000", "width": 3,
+                                                              "points": chunk(steps * POINTS_PER_MESSAGE)}})
+            await asyncio.sleep(rng.uniform(0.2, 0.8))
+
+
+class ServerProcess:
+    """CPU time and RSS of the server: its process and direct children (the workers), from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.tick = os.sysconf("SC_CLK_TCK")
+
+    def pids(self):
+        found = [self.pid]
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        if int(f.read().rsplit(")", 1)[1].split()[1]) == self.pid:
+                            found.append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    pass
+        return found
+
+    def cpu(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total += int(fields[11]) + int(fields[12])
+            except (OSError, IndexError):
+                pass
+        return total / self.tick
+
+    def rss(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f"/proc/{pid}/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            total += int(line.split()[1]) * 1024
+            except OSError:
+                pass
+        return total
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 2)
+    return {"p50": pick(0.5), "p99": pick(0.99), "max": round(samples[-1] * 1000, 2), "n": len(samples)}
+
+
+async def fetch_metrics(session, base):
+    try:
+        async with session.get(base + "/metrics") as resp:
+            return await resp.json()
+    except aiohttp.ClientError:
+        return {}
+
+
+async def measure(name, session, base, server, work):
+    """Run one phase and return its figures."""
+    global stats
+    stats = Stats()
+    before = await fetch_metrics(session, base)
+    cpu0, own0, start = server.cpu() if server else None, time.process_time(), clock()
+    peak = [0]
+
+    async def sample_rss():
+        while True:
+            peak[0] = max(peak[0], server.rss())
+            await asyncio.sleep(0.25)
+
+    sampler = asyncio.ensure_future(sample_rss()) if server else None
+    await work()
+    elapsed = clock() - start
+    own = time.process_time() - own0
+    if sampler:
+        sampler.cancel()
+    # frames still in flight are counted, not timed against the next phase
+    await asyncio.sleep(0.2)
+    after = await fetch_metrics(session, base)
+    result = {
+        "seconds": round(elapsed, 2),
+        "msgs_sent": stats.sent,
+        "msgs_sent_per_s": round(stats.sent / elapsed, 1),
+        "frames_received": stats.received,
+        "frames_received_per_s": round(stats.received / elapsed, 1),
+        "join_ms": percentiles(stats.joins),
+        "fanout_ms": percentiles(stats.fanout()),
+        "errors": stats.errors,
+        "loadgen_cpu_pct": round(100 * own / elapsed, 1),
+        "metrics": {k: v if k in GAUGES else v - before.get(k, 0) for k, v in after.items() if type(v) in (int, float)},
+    }
+    if server:
+        cpu = server.cpu() - cpu0
+        result.update(server_cpu_s=round(cpu, 2), server_cpu_pct=round(100 * cpu / elapsed, 1),
+                      server_rss_max_mb=round(peak[0] / 2 ** 20, 1), server_rss_end_mb=round(server.rss() / 2 ** 20, 1))
+    print_phase(name, result)
+    return result
+
+
+def print_phase(name, result):
+    print(f"{name}: {result['seconds']} s, {result['msgs_sent_per_s']:,.0f} msg/s sent, "
+          f"{result['frames_received_per_s']:,.0f} frames/s received, load generator {result['loadgen_cpu_pct']}% CPU")
+    for key in ("join_ms", "fanout_ms"):
+        if result[key]:
+            print(f"  {key[:-3]:7} p50 {result[key]['p50']} ms, p99 {result[key]['p99']} ms ({result[key]['n']} samples)")
+    if "server_cpu_pct" in result:
+        print(f"  server  {result['server_cpu_pct']}% CPU, {result['server_rss_max_mb']} MB RSS at most")
+    if result["errors"]:
+        print(f"  errors  {result['errors']}")
+
+
+async def create_class(session, base):
+    form = aiohttp.FormData()
+    form.add_field("pdf", PDF, filename="bench.pdf", content_type="application/pdf")
+    async with session.post(base + "/upload", data=form) as resp:
+        created = await resp.json()
+    if not created.get("ok"):
+        raise RuntimeError(f"upload failed: {created}")
+    return created["class_id"], created["teacher_key"]
+
+
+async def run(args, server):
+    base = args.url.rstrip("/")
+    ws_url = base.replace("http", "ws", 1) + "/ws"
+    features = [f for f in args.features.split(",") if f]
+    rng = random.Random(args.seed)
+    results = {}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        teachers, students = [], []
+        for c in range(args.classes):
+            class_id, key = await create_class(session, base)
+            teachers.append(Client(session, ws_url, {"type": "join", "role": "teacher", "class_id": class_id, "key": key, "features": features}))
+            for s in range(args.students):
+                students.append(Client(session, ws_url, {"type": "join", "role": "student", "class_id": class_id, "name": f"s{c}-{s}",
+                                                         "features": features}, drawer=s < args.student_drawers))
+        drawers = teachers + [s for s in students if s.drawer]
+        watchers = [s for s in students if not s.drawer]
+
+        async def join_storm():
+            await asyncio.gather(*(t.connect() for t in teachers))
+
+            async def arrive(client, delay):
+                await asyncio.sleep(delay)
+                await client.connect()
+
+            await asyncio.gather(*(arrive(s, rng.uniform(0, args.storm)) for s in students))
+
+        async def clears(until):
+            while clock() + args.clear_every < until:
+                await asyncio.sleep(args.clear_every)
+                for t in teachers:
+                    await t.send({"type": "clear_annotations"})
+
+        async def draw():
+            until = clock() + args.duration
+            jobs = [d.draw(until, random.Random(rng.random())) for d in drawers]
+            if args.clear_every > 0:
+                jobs.append(clears(until))
+            await asyncio.gather(*jobs)
+
+        async def churn():
+            until = clock() + args.duration
+            reconnects = []
+
+            async def cycle():
+                while clock() < until:
+                    await asyncio.sleep(rng.expovariate(args.churn))
+                    idle = [s for s in watchers if not s.busy]
+                    if idle:
+                        reconnects.append(asyncio.ensure_future(rng.choice(idle).reconnect()))
+                await asyncio.gather(*reconnects)
+
+            await asyncio.gather(draw(), cycle())
+
+        results["join"] = await measure("join", session, base, server, join_storm)
+        results["draw"] = await measure("draw", session, base, server, draw)
+        if args.churn > 0 and watchers:
+            results["churn"] = await measure("churn", session, base, server, churn)
+        for client in teachers + students:
+            await client.close()
+    return results
+
+
+async def wait_until_up(base, proc):
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with {proc.returncode}")
+            if await fetch_metrics(session, base):
+                return
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not come up")
+
+
+def spawn_server(port):
+    """app.py and static/ copied to a temporary directory and started there."""
+    workdir = tempfile.mkdtemp(prefix="bench-load-")
+    shutil.copy(os.path.join(HERE, "app.py"), workdir)
+    shutil.copytree(os.path.join(HERE, "static"), os.path.join(workdir, "static"))
+    proc = subprocess.Popen([sys.executable, os.path.join(workdir, "app.py")], cwd=workdir,
+                            env=dict(os.environ, PORT=str(port)), stdout=subprocess.DEVNULL)
+    return proc, workdir
+
+
+def flatten(d, prefix=""):
+    flat = {}
+    for k, v in d.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, f"{prefix}{k}."))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[prefix + k] = v
+    return flat
+
+
+def compare(results, baseline):
+    print(f"\ncompared with {baseline['when']}:")
+    for phase, figures in results.items():
+        old = flatten(baseline["phases"].get(phase, {}))
+        for key, value in flatten(figures).items():
+            if key in old and not key.startswith("metrics.") and old[key]:
+                print(f"  {phase}.{key:28} {value:>12,.2f}  was {old[key]:>12,.2f}  ({100 * (value - old[key]) / old[key]:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="server to load (default: the one --spawn starts)")
+    parser.add_argument("--spawn", action="store_true", help="start a scratch copy of app.py for the run")
+    parser.add_argument("--port", type=int, default=8099, help="port of the --spawn server")
+    parser.add_argument("--pid", type=int, help="server process for CPU and RSS figures (known with --spawn)")
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--students", type=int, default=30, help="per class")
+    parser.add_argument("--student-drawers", type=int, default=0, help="students per class drawing alongside the teacher")
+    parser.add_argument("--features", default=FEATURES, help="protocol features every client asks for")
+    parser.add_argument("--storm", type=float, default=5, help="seconds over which the students join")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of the draw and churn phases")
+    parser.add_argument("--clear-every", type=float, default=4, help="seconds between clears (0: none)")
+    parser.add_argument("--churn", type=float, default=5, help="student reconnects per second in the churn phase (0: skip it)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the results here as JSON")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare with")
+    args = parser.parse_args()
+    if not args.url and not args.spawn:
+        parser.error("give --url or --spawn")
+    if args.student_drawers > args.students:
+        parser.error("--student-drawers exceeds --students")
+
+    proc = workdir = None
+    if args.spawn:
+        proc, workdir = spawn_server(args.port)
+        args.url = args.url or f"http://127.0.0.1:{args.port}"
+        args.pid = proc.pid
+    try:
+        if proc:
+            asyncio.run(wait_until_up(args.url.rstrip("/"), proc))
+        server = ServerProcess(args.pid) if args.pid and os.path.isdir("/proc") else None
+        results = asyncio.run(run(args, server))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"when": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "pid")},
+              "phases": results}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
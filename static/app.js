@@ -37,6 +37,8 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
   const clearStudentAllBtn = document.getElementById('clearStudentAllBtn');
 
   const clearMyBtn = document.getElementById('clearMyBtn');
+  const undoButtons = [document.getElementById('undoTeacherBtn'), document.getElementById('undoMyBtn')];
+  const redoButtons = [document.getElementById('redoTeacherBtn'), document.getElementById('redoMyBtn')];
 
   const pdfContainer = document.getElementById('pdfContainer');
   const annotatorBadge = document.getElementById('annotatorBadge');
@@ -55,6 +57,25 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
   let currentAnnotator = null;
   let isDrawing = false;
   let currentStroke = null;
+  let serverFeatures = [];  // protocol extensions accepted in 'joined'
+  let liveStrokes = {};     // stroke_id -> stroke other people are still drawing
+  let nextStrokeId = 1;
+  let lastSeq = null;       // seq of the newest stroke change applied ('resume')
+  let currentJoin = null;   // join message of the open connection, replayed on reconnect
+  let pdfUrl = null;
+  let unackedStrokes = {};  // own stroke_id -> {page, stroke} drawn locally, waiting for its server id ('ids')
+  let streamTimer = null;
+  let unsentPoints = [];    // points of currentStroke not yet sent as stroke_points
+  let missingPages = [];    // annotated pages whose strokes have not been fetched yet ('paged')
+  let pageRequested = null; // page of the get_page_strokes in flight
+  let participants = new Map(); // client id -> {name, role}, in join order
+
+  // protocol extensions this client understands (sent with every join)
+  const CLIENT_FEATURES = ['stream', 'q16', 'paged', 'ids', 'resume', 'batch', 'presence'];
+  const STREAM_INTERVAL_MS = 40;
+  const RECONNECT_MS = 1500;
+  // show server-rendered page images instead of running PDF.js (slow devices, or ?raster in the URL)
+  const USE_RASTER = new URLSearchParams(location.search).has('raster') || (navigator.hardwareConcurrency || 4) <= 2;
 
   // localStorage keys
   const LS_ROLE = "pdfannot_role";
@@ -108,18 +129,111 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
   // connect + join helper
   function connectAndJoin(joinMsg) {
     if (socket) socket.close();
+    currentJoin = joinMsg;
     const proto = (location.protocol === 'https:') ? 'wss' : 'ws';
-    socket = new WebSocket(`${proto}://${location.host}/ws`);
-    socket.onopen = () => {
-      socket.send(JSON.stringify(joinMsg));
+    const ws = socket = new WebSocket(`${proto}://${location.host}/ws`);
+    ws.onopen = () => {
+      ws.send(JSON.stringify(Object.assign({features: CLIENT_FEATURES}, joinMsg)));
       statusEl.textContent = 'Connected — joining...';
     };
-    socket.onmessage = (evt) => {
-      const msg = JSON.parse(evt.data);
+    ws.onmessage = (evt) => {
+      const msg = unpackStrokes(JSON.parse(evt.data));
+      if (typeof msg.seq === 'number') lastSeq = msg.seq;
       handleMessage(msg);
     };
-    socket.onclose = () => { statusEl.textContent = 'Disconnected'; };
-    socket.onerror = (e) => { console.error('ws error', e); };
+    ws.onclose = () => {
+      if (ws !== socket) return; // replaced by a newer connection
+      statusEl.textContent = 'Disconnected — reconnecting...';
+      setTimeout(rejoin, RECONNECT_MS);
+    };
+    ws.onerror = (e) => { console.error('ws error', e); };
+  }
+
+  // join the same class again, asking only for the stroke changes missed meanwhile
+  function rejoin() {
+    if (!currentJoin || (socket && socket.readyState !== WebSocket.CLOSED)) return;
+    const msg = Object.assign({}, currentJoin);
+    if (myRole === 'student' && myToken) msg.student_token = myToken;
+    if (lastSeq !== null && msg.class_id === currentClass) msg.last_seq = lastSeq;
+    connectAndJoin(msg);
+  }
+
+  // ---------------- q16 point packing (mirrors pack_points in app.py) ----------------
+  // uint16-quantized coordinates, delta + zigzag + LEB128 varint, base64
+  const Q16_SCALE = 65535;
+
+  function packPoints(points) {
+    const bytes = [];
+    let px = 0, py = 0;
+    for (const pt of points) {
+      const x = Math.min(Q16_SCALE, Math.max(0, Math.round(pt.x * Q16_SCALE)));
+      const y = Math.min(Q16_SCALE, Math.max(0, Math.round(pt.y * Q16_SCALE)));
+      for (let d of [x - px, y - py]) {
+        d = ((d + 0x8000) & 0xFFFF) - 0x8000;
+        let z = d >= 0 ? d * 2 : -d * 2 - 1;
+        while (z >= 0x80) { bytes.push((z & 0x7F) | 0x80); z >>>= 7; }
+        bytes.push(z);
+      }
+      px = x; py = y;
+    }
+    let bin = '';
+    for (const b of bytes) bin += String.fromCharCode(b);
+    return btoa(bin);
+  }
+
+  function unpackPoints(packed) {
+    const bin = atob(packed);
+    const values = [];
+    let z = 0, shift = 0;
+    for (let i = 0; i < bin.length; i++) {
+      const b = bin.charCodeAt(i);
+      z |= (b & 0x7F) << shift;
+      if (b & 0x80) { shift += 7; continue; }
+      values.push((z & 1) ? -((z + 1) >>> 1) : (z >>> 1));
+      z = 0; shift = 0;
+    }
+    const points = [];
+    let x = 0, y = 0;
+    for (let i = 0; i + 1 < values.length; i += 2) {
+      x = (x + values[i]) & 0xFFFF;
+      y = (y + values[i + 1]) & 0xFFFF;
+      points.push({x: x / Q16_SCALE, y: y / Q16_SCALE});
+    }
+    return points;
+  }
+
+  // replace every packed "p" in an incoming message with a "points" list
+  function unpackStrokes(obj) {
+    if (Array.isArray(obj)) { obj.forEach(unpackStrokes); return obj; }
+    if (!obj || typeof obj !== 'object') return obj;
+    for (const k of Object.keys(obj)) {
+      if (k === 'p') { obj.points = unpackPoints(obj.p); delete obj.p; }
+      else if (k !== 'points' && obj[k] && typeof obj[k] === 'object') unpackStrokes(obj[k]);
+    }
+    return obj;
+  }
+
+  // points field of an outgoing stroke message, packed when the server speaks q16
+  function pointsField(points) {
+    return serverFeatures.indexOf('q16') !== -1 ? {p: packPoints(points)} : {points: points};
+  }
+
+  // false when a stroke with that id is already there ('batch' strokes can also come in a snapshot)
+  function addStroke(st) {
+    const list = appliedStrokes[st.page] = appliedStrokes[st.page] || [];
+    if (st.id !== undefined && list.some(s => s.id === st.id)) return false;
+    list.push({id: st.id, author: st.author, color: st.color, width: st.width, points: st.points});
+    return true;
+  }
+
+  function renderParticipants() {
+    participantsTeacher.innerHTML = '';
+    participantsStudent.innerHTML = '';
+    participants.forEach(p => {
+      const li = document.createElement('li'); li.textContent = p.name + (p.role === 'teacher' ? ' (Teacher)' : '');
+      participantsTeacher.appendChild(li);
+      participantsStudent.appendChild(li.cloneNode(true));
+    });
   }
 
   function handleMessage(msg) {
@@ -134,6 +248,14 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
         myId = msg.id;
         myRole = msg.role;
         currentClass = msg.class_id;
+        serverFeatures = msg.features || [];
+        // strokes we sent but never saw confirmed are either among the replayed changes or lost
+        Object.values(unackedStrokes).forEach(own => {
+          appliedStrokes[own.page] = (appliedStrokes[own.page] || []).filter(s => s !== own.stroke);
+        });
+        unackedStrokes = {};
+        liveStrokes = {};
+        if (msg.resumed) Object.keys(pageCanvases).forEach(p => redrawPage(parseInt(p)));
         statusEl.textContent = `Connected as ${myRole} (class ${currentClass})`;
 
         // persist role/class for reconnect
@@ -142,7 +264,8 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
 
         if (myRole === 'teacher') {
           if (msg.teacher_key) localStorage.setItem(LS_TEACHER_KEY, msg.teacher_key);
-          classInfo.innerHTML = `<div>Class ID: <b>${currentClass}</b></div><div>Teacher Key: <b>${msg.teacher_key || ''}</b></div>`;
+          classInfo.innerHTML = `<div>Class ID: <b>${currentClass}</b></div><div>Teacher Key: <b>${msg.teacher_key || ''}</b></div>` +
+            `<div><a href="/export/${currentClass}.pdf?key=${encodeURIComponent(msg.teacher_key || '')}">Download annotated PDF</a></div>`;
           myToken = 'teacher';
         } else {
           if (msg.student_token) {
@@ -153,17 +276,25 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
           requestAnnotateBtn.disabled = false;
         }
 
-        if (msg.pdf_url) loadPdf(msg.pdf_url);
+        if (msg.pdf_url && !(msg.resumed && msg.pdf_url === pdfUrl)) {
+          if (msg.pages_url && USE_RASTER) loadPages(msg.pages_url, msg.pdf_url);
+          else loadPdf(msg.pdf_url);
+        }
         break;
 
       case 'presence':
-        participantsTeacher.innerHTML = '';
-        participantsStudent.innerHTML = '';
-        (msg.clients || []).forEach(p => {
-          const li = document.createElement('li'); li.textContent = p.name + (p.role === 'teacher' ? ' (Teacher)' : '');
-          participantsTeacher.appendChild(li);
-          participantsStudent.appendChild(li.cloneNode(true));
-        });
+        participants = new Map((msg.clients || []).map(p => [p.id, p]));
+        renderParticipants();
+        break;
+
+      case 'presence_leave':
+        msg.ids.forEach(id => participants.delete(id));
+        renderParticipants();
+        break;
+
+      case 'presence_join':
+        msg.clients.forEach(p => participants.set(p.id, p));
+        renderParticipants();
         break;
 
       case 'pending_list':
@@ -196,16 +327,87 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
 
       case 'init_strokes':
         appliedStrokes = msg.strokes || {};
+        // a paged snapshot holds only msg.page; the other annotated pages are fetched one at a time
+        missingPages = msg.paged ? (msg.pages || []).filter(p => p !== msg.page) : [];
+        pageRequested = null;
+        requestNextPage();
+        liveStrokes = {};
+        (msg.live || []).forEach(st => { liveStrokes[st.stroke_id] = st; });
         Object.keys(pageCanvases).forEach(p => redrawPage(parseInt(p)));
         break;
 
+      case 'page_strokes':
+        // the reply already contains every stroke broadcast before it, so it replaces the page
+        appliedStrokes[msg.page] = msg.strokes || [];
+        missingPages = missingPages.filter(p => p !== msg.page);
+        if (pageRequested === msg.page) pageRequested = null;
+        if (pageCanvases[msg.page]) redrawPage(parseInt(msg.page));
+        requestNextPage();
+        break;
+
+      case 'stroke_begin':
+        liveStrokes[msg.stroke_id] = {page: msg.page, author: msg.author, color: msg.color, width: msg.width, points: msg.points || []};
+        if (pageCanvases[msg.page]) redrawPage(parseInt(msg.page));
+        break;
+
+      case 'stroke_points': {
+        const live = liveStrokes[msg.stroke_id];
+        if (!live) break;
+        const from = Math.max(0, live.points.length - 1);
+        live.points.push(...msg.points);
+        // only the new segment needs painting
+        drawStrokeOnCanvas({color: live.color, width: live.width, points: live.points.slice(from)}, live.page);
+        break;
+      }
+
+      case 'stroke_end': {
+        const live = liveStrokes[msg.stroke_id];
+        if (!live) break;
+        delete liveStrokes[msg.stroke_id];
+        if (!msg.aborted) {
+          live.points.push(...(msg.points || []));
+          appliedStrokes[live.page] = appliedStrokes[live.page] || [];
+          appliedStrokes[live.page].push({id: msg.id, author: live.author, color: live.color, width: live.width, points: live.points});
+        }
+        if (pageCanvases[live.page]) redrawPage(parseInt(live.page));
+        break;
+      }
+
       case 'apply_stroke':
-        const st = msg.stroke;
-        appliedStrokes[st.page] = appliedStrokes[st.page] || [];
-        appliedStrokes[st.page].push({author: st.author, color: st.color, width: st.width, points: st.points});
-        if (pageCanvases[st.page]) redrawPage(parseInt(st.page));
+        if (addStroke(msg.stroke) && pageCanvases[msg.stroke.page]) redrawPage(parseInt(msg.stroke.page));
         break;
 
+      case 'apply_strokes': {
+        const pages = new Set(msg.strokes.filter(addStroke).map(st => st.page));
+        pages.forEach(p => { if (pageCanvases[p]) redrawPage(parseInt(p)); });
+        break;
+      }
+
+      case 'stroke_ack': {
+        const own = unackedStrokes[msg.stroke_id];
+        if (!own) break;
+        delete unackedStrokes[msg.stroke_id];
+        own.stroke.id = msg.id;
+        // a resync snapshot taken before the server had the stroke replaced our local copy
+        const list = appliedStrokes[own.page] = appliedStrokes[own.page] || [];
+        if (!list.some(s => s.id === msg.id)) {
+          list.push(own.stroke);
+          if (pageCanvases[own.page]) redrawPage(parseInt(own.page));
+        }
+        break;
+      }
+
+      case 'remove_strokes': {
+        const gone = new Set(msg.ids || []);
+        Object.keys(appliedStrokes).forEach(p => {
+          const kept = appliedStrokes[p].filter(s => !gone.has(s.id));
+          if (kept.length === appliedStrokes[p].length) return;
+          appliedStrokes[p] = kept;
+          if (pageCanvases[p]) redrawPage(parseInt(p));
+        });
+        break;
+      }
+
       case 'clear_annotations':
         appliedStrokes = {};
         Object.keys(pageCanvases).forEach(p => redrawPage(parseInt(p)));
@@ -224,6 +426,14 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
     }
   }
 
+  // fetch the missing page closest to what is on screen
+  function requestNextPage() {
+    if (pageRequested !== null || !missingPages.length || !socket) return;
+    const here = visibleTopPage();
+    pageRequested = missingPages.reduce((best, p) => Math.abs(p - here) < Math.abs(best - here) ? p : best);
+    socket.send(JSON.stringify({type:'get_page_strokes', page: pageRequested}));
+  }
+
   // UI helpers
   function addPendingItem(reqid, name, page, note) {
     const el = document.createElement('div'); el.className = 'pending-entry';
@@ -319,6 +529,22 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
     socket.send(JSON.stringify({type:'clear_my_annotations'}));
   });
 
+  // undo / redo own strokes (buttons, Ctrl+Z, Ctrl+Shift+Z / Ctrl+Y)
+  function sendUndo(redo) {
+    if (!socket) return;
+    socket.send(JSON.stringify({type: redo ? 'redo_stroke' : 'undo_stroke'}));
+  }
+  undoButtons.forEach(b => b.addEventListener('click', () => sendUndo(false)));
+  redoButtons.forEach(b => b.addEventListener('click', () => sendUndo(true)));
+  document.addEventListener('keydown', (e) => {
+    if (!(e.ctrlKey || e.metaKey) || e.target.tagName === 'INPUT') return;
+    const key = e.key.toLowerCase();
+    if (key === 'z' || key === 'y') {
+      e.preventDefault();
+      sendUndo(key === 'y' || e.shiftKey);
+    }
+  });
+
   stopAnnotateBtn.addEventListener('click', () => {
     if (!socket) return;
     socket.send(JSON.stringify({type:'revoke'}));
@@ -328,6 +554,7 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
   async function loadPdf(url) {
     statusEl.textContent = 'Loading PDF...';
     pdfDoc = await pdfjsLib.getDocument(url).promise;
+    pdfUrl = url;
     pdfContainer.innerHTML = ''; pageCanvases = {};
     for (let p = 1; p <= pdfDoc.numPages; ++p) {
       const page = await pdfDoc.getPage(p);
@@ -363,6 +590,42 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
     statusEl.textContent = `PDF loaded (${pdfDoc.numPages} pages)`;
   }
 
+  // same layout as loadPdf, but each page is an <img> rendered by the server
+  async function loadPages(pagesUrl, url) {
+    statusEl.textContent = 'Loading pages...';
+    const info = await (await fetch(pagesUrl)).json();
+    pdfDoc = null;
+    pdfUrl = url;
+    pdfContainer.innerHTML = ''; pageCanvases = {};
+    const containerWidth = Math.max(300, Math.min(window.innerWidth, pdfContainer.clientWidth || window.innerWidth));
+    info.sizes.forEach(([w, h], i) => {
+      const p = i + 1;
+      const scale = Math.min(1.8, (containerWidth - 24) / w);
+      const width = Math.floor(w * scale), height = Math.floor(h * scale);
+      const pageWrap = document.createElement('div');
+      pageWrap.className = 'page-wrap';
+      pageWrap.dataset.page = p;
+      const img = document.createElement('img');
+      img.className = 'pdf-page';
+      img.width = width; img.height = height;
+      img.style.width = width + 'px'; img.style.height = height + 'px';
+      img.loading = 'lazy';
+      img.src = `${pagesUrl}/${p}?w=${Math.ceil(width * (window.devicePixelRatio || 1))}`;
+      const annoCanvas = document.createElement('canvas');
+      annoCanvas.className = 'anno-page';
+      annoCanvas.width = width; annoCanvas.height = height;
+      annoCanvas.style.width = img.style.width; annoCanvas.style.height = img.style.height;
+      annoCanvas.dataset.page = p;
+      attachDrawingHandlers(annoCanvas, p);
+      pageWrap.appendChild(img);
+      pageWrap.appendChild(annoCanvas);
+      pdfContainer.appendChild(pageWrap);
+      pageCanvases[p] = {pdfCanvas: img, annoCanvas, width, height};
+    });
+    Object.keys(appliedStrokes).forEach(page => redrawPage(parseInt(page)));
+    statusEl.textContent = `Pages loaded (${info.pages} pages)`;
+  }
+
   function visibleTopPage(){
     const wraps = Array.from(document.querySelectorAll('.page-wrap'));
     for (const w of wraps) {
@@ -380,26 +643,51 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
   }
 
   // ---------------- Drawing helpers ----------------
+  function streaming() {
+    return socket && serverFeatures.indexOf('stream') !== -1;
+  }
+
+  function flushStrokePoints() {
+    if (!currentStroke || !unsentPoints.length) return;
+    socket.send(JSON.stringify(Object.assign({type:'stroke_points', stroke_id: currentStroke.id}, pointsField(unsentPoints))));
+    unsentPoints = [];
+  }
+
   function attachDrawingHandlers(canvas, page) {
     canvas.addEventListener('pointerdown', (e) => {
       if (!(myRole === 'teacher' || currentAnnotator === myToken)) return;
       isDrawing = true;
-      currentStroke = {page: page, points: [pointerToNormalized(e, canvas)], color: colorPicker.value, width: parseInt(widthPicker.value, 10)};
+      currentStroke = {id: nextStrokeId++, page: page, points: [pointerToNormalized(e, canvas)], color: colorPicker.value, width: parseInt(widthPicker.value, 10)};
       canvas.setPointerCapture(e.pointerId);
+      if (streaming()) {
+        socket.send(JSON.stringify(Object.assign({type:'stroke_begin', stroke_id: currentStroke.id, page: page.toString(), color: currentStroke.color, width: currentStroke.width}, pointsField(currentStroke.points))));
+        unsentPoints = [];
+        streamTimer = setInterval(flushStrokePoints, STREAM_INTERVAL_MS);
+      }
     });
     canvas.addEventListener('pointermove', (e) => {
       if (!isDrawing || !currentStroke) return;
-      currentStroke.points.push(pointerToNormalized(e, canvas));
+      const pt = pointerToNormalized(e, canvas);
+      currentStroke.points.push(pt);
+      unsentPoints.push(pt);
       redrawPage(page);
       drawStrokeOnCanvas(currentStroke, page);
     });
     canvas.addEventListener('pointerup', (e) => {
       if (!isDrawing) return;
       isDrawing = false;
+      if (streamTimer) { clearInterval(streamTimer); streamTimer = null; }
       if (currentStroke && currentStroke.points.length > 0) {
+        const mine = {author: myToken === null ? "anon" : myToken, color: currentStroke.color, width: currentStroke.width, points: currentStroke.points};
         appliedStrokes[page] = appliedStrokes[page] || [];
-        appliedStrokes[page].push({author: myToken === null ? "anon" : myToken, color: currentStroke.color, width: currentStroke.width, points: currentStroke.points});
-        if (socket) socket.send(JSON.stringify({type:'stroke', stroke: {page: page.toString(), color: currentStroke.color, width: currentStroke.width, points: currentStroke.points}}));
+        appliedStrokes[page].push(mine);
+        unackedStrokes[currentStroke.id] = {page: page.toString(), stroke: mine};
+        if (streaming()) {
+          socket.send(JSON.stringify(Object.assign({type:'stroke_end', stroke_id: currentStroke.id}, pointsField(unsentPoints))));
+          unsentPoints = [];
+        } else if (socket) {
+          socket.send(JSON.stringify({type:'stroke', stroke: Object.assign({stroke_id: currentStroke.id, page: page.toString(), color: currentStroke.color, width: currentStroke.width}, pointsField(currentStroke.points))}));
+        }
         currentStroke = null;
       }
     });
@@ -441,6 +729,7 @@ pdfjsLib.GlobalWorkerOptions.workerSrc = 'https://cdnjs.cloudflare.com/ajax/libs
     const ctx = meta.annoCanvas.getContext('2d');
     ctx.clearRect(0,0,meta.annoCanvas.width, meta.annoCanvas.height);
     (appliedStrokes[page] || []).forEach(s => drawStrokeOnCanvas(s, page));
+    Object.values(liveStrokes).forEach(s => { if (String(s.page) === String(page)) drawStrokeOnCanvas(s, page); });
     if (currentStroke && currentStroke.page === page) drawStrokeOnCanvas(currentStroke, page);
   }
 
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# app.py lives at the repository root, next to this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """An empty STATE_DIR and legacy file paths under tmp_path, with no classes loaded."""
+    state_dir = tmp_path / "state"
+    monkeypatch.setattr(app, "STATE_DIR", str(state_dir))
+    monkeypatch.setattr(app, "LEGACY_STATE_FILE", str(tmp_path / "state.json"))
+    monkeypatch.setattr(app, "LEGACY_JOURNAL_FILE", str(tmp_path / "state.journal"))
+    monkeypatch.setattr(app, "classes", {})
+    monkeypatch.setattr(app, "pending_lines", {})
+    return state_dir
@@ -0,0 +1,119 @@
+"""Stored PDFs: content-addressed storage and conditional requests for /files/."""
+import asyncio
+import gzip
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import app
+
+PDF = b"%PDF-1.4\n" + b"0123456789 compressible filler\n" * 400
+
+
+@pytest.fixture
+def blob(tmp_path, monkeypatch):
+    """A stored PDF (with its gzip copy) in an empty UPLOAD_DIR; its URL path and hash."""
+    monkeypatch.setattr(app, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "PDF_REFS_DIR", str(tmp_path / "refs"))
+    sha = hashlib.sha256(PDF).hexdigest()
+    with open(tmp_path / f"{sha}.pdf", "wb") as f:
+        f.write(PDF)
+    with open(tmp_path / f"{sha}.pdf.gz", "wb") as f:
+        f.write(gzip.compress(PDF))
+    return f"/files/{sha}.pdf", sha
+
+
+def test_concurrent_uploads_store_a_new_pdf_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "PDF_REFS_DIR", str(tmp_path / "refs"))
+    monkeypatch.setattr(app, "PRECOMPRESS_PDFS", True)
+    sha = hashlib.sha256(PDF).hexdigest()
+    uploads = []
+    for i in range(8):
+        with open(tmp_path / f"upload{i}.part", "wb") as f:
+            f.write(PDF)
+        uploads.append((str(tmp_path / f"upload{i}.part"), sha, f"class{i}"))
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda args: app.store_pdf(*args), uploads))
+    assert sorted(reused for _, reused in results) == [False] + [True] * 7
+    assert {filename for filename, _ in results} == {f"{sha}.pdf"}
+    assert sorted(os.listdir(tmp_path)) == sorted(["refs", f"{sha}.pdf", f"{sha}.pdf.gz"])
+    assert sorted(os.listdir(tmp_path / "refs" / sha)) == [f"class{i}" for i in range(8)]
+    with open(tmp_path / f"{sha}.pdf", "rb") as f:
+        assert f.read() == PDF
+    with gzip.open(tmp_path / f"{sha}.pdf.gz") as f:
+        assert f.read() == PDF
+
+
+def test_concurrent_precompress_leaves_one_whole_copy(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    with open(path, "wb") as f:
+        f.write(PDF)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(app.precompress, [path] * 8))
+    assert sorted(os.listdir(tmp_path)) == ["doc.pdf", "doc.pdf.gz"]
+    with gzip.open(path + ".gz") as f:
+        assert f.read() == PDF
+
+
+def get(path, **headers):
+    """(status, headers, raw body) of one GET through serve_file."""
+    async def run():
+        server = web.Application()
+        server.on_response_prepare.append(app.set_content_etag)
+        server.router.add_get("/files/{filename}", app.serve_file)
+        async with TestClient(TestServer(server), auto_decompress=False) as client:
+            resp = await client.get(path, headers={k.replace("_", "-"): v for k, v in headers.items()})
+            return resp.status, resp.headers, await resp.read()
+    return asyncio.run(run())
+
+
+def test_each_encoding_has_its_own_hash_etag(blob):
+    path, sha = blob
+    status, headers, body = get(path, Accept_Encoding="identity")
+    assert (status, headers["ETag"], body) == (200, f'"{sha}"', PDF)
+    assert headers["Cache-Control"] == app.IMMUTABLE
+    status, headers, body = get(path, Accept_Encoding="gzip, deflate")
+    assert (status, headers["ETag"], headers["Content-Encoding"]) == (200, f'"{sha}-gz"', "gzip")
+    assert gzip.decompress(body) == PDF
+
+
+def test_if_none_match(blob):
+    path, sha = blob
+    assert get(path, Accept_Encoding="identity", If_None_Match=f'"{sha}"')[0] == 304
+    assert get(path, Accept_Encoding="gzip", If_None_Match=f'"{sha}-gz"')[0] == 304
+    # the gzip copy's ETag does not validate the identity bytes
+    assert get(path, Accept_Encoding="identity", If_None_Match=f'"{sha}-gz"')[0] == 200
+    assert get(path, If_None_Match="*")[0] == 304
+
+
+def test_if_match(blob):
+    path, sha = blob
+    assert get(path, Accept_Encoding="identity", If_Match=f'"{sha}"')[0] == 200
+    assert get(path, Accept_Encoding="identity", If_Match='"other"')[0] == 412
+    assert get(path, Accept_Encoding="identity", If_Match=f'W/"{sha}"')[0] == 412
+
+
+def test_if_modified_since(blob):
+    path, sha = blob
+    status, headers, body = get(path, If_Modified_Since="Thu, 01 Jan 1970 00:00:01 GMT")
+    assert (status, body) == (304, b"")
+    assert headers["Cache-Control"] == app.IMMUTABLE
+    # If-None-Match wins when both are sent
+    assert get(path, Accept_Encoding="identity", If_None_Match='"other"', If_Modified_Since="Thu, 01 Jan 1970 00:00:01 GMT")[0] == 200
+    assert get(path, If_Modified_Since="not a date")[0] == 200
+
+
+def test_ranges_are_of_the_identity_file(blob):
+    path, sha = blob
+    status, headers, body = get(path, Accept_Encoding="gzip", Range="bytes=0-99")
+    assert (status, headers["ETag"], body) == (206, f'"{sha}"', PDF[:100])
+    assert "Content-Encoding" not in headers
+    assert get(path, Range="bytes=0-99", If_Range=f'"{sha}"')[0] == 206
+    # a validator for something else: the whole file instead
+    status, _, body = get(path, Range="bytes=0-99", If_Range='"other"')
+    assert (status, body) == (200, PDF)
@@ -0,0 +1,156 @@
+"""Client messages through handle_message, with no sockets: frames are recorded as sent."""
+import asyncio
+import os
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import app
+
+
+class RecordingOutbox:
+    """Outbox that keeps every frame it is given, decoded."""
+
+    def __init__(self):
+        self.frames = ()
+        self.sent = []
+
+    def push(self, frame):
+        self.sent.append(app.decode(frame.data))
+        return True
+
+    def drop(self, kinds):
+        return 0
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server(state, monkeypatch):
+    """A class "c1" (teacher key KEY123) in an empty STATE_DIR, and no clients."""
+    os.makedirs(state)
+    for name in ("clients", "class_clients", "token_clients"):
+        monkeypatch.setattr(app, name, {})
+    app.classes["c1"] = app.hydrate_room({"teacher_key": "KEY123", "pdf_filename": "doc.pdf", "students": {}, "pending": {},
+                                          "last_student_annotator": None, "current_annotator": None})
+    app.journal_meta("c1")
+    return app.classes["c1"]
+
+
+def connect(client_id):
+    info = app.clients[client_id] = app.new_client(client_id, None, None, RecordingOutbox())
+    return info
+
+
+async def send(client_id, data):
+    await app.handle_message(client_id, app.clients[client_id], data)
+    return app.clients[client_id]["outbox"].sent
+
+
+async def join_teacher(client_id="t"):
+    connect(client_id)
+    return await send(client_id, {"type": "join", "role": "teacher", "class_id": "c1", "key": "KEY123"})
+
+
+async def join_student(client_id, name):
+    connect(client_id)
+    return await send(client_id, {"type": "join", "role": "student", "class_id": "c1", "name": name})
+
+
+def test_lone_surrogate_name_does_not_break_the_class(server, monkeypatch):
+    # the stdlib fallback, as shipped without orjson
+    monkeypatch.setattr(app, "orjson", None)
+
+    async def run():
+        await join_student("s1", "\ud800x")
+        sent = await join_student("s2", "Bo")
+        assert sent[0]["type"] == "joined"
+        await app.flush_persistence(compact=["c1"])
+    asyncio.run(run())
+    names = sorted(st["name"] for st in app.read_room("c1")["students"].values())
+    assert names == ["Bo", "\ud800x"]
+
+
+def test_owner_answers_resync_with_init_strokes(server, monkeypatch):
+    published = []
+    monkeypatch.setattr(app, "backplane", type("Recorder", (), {"publish": lambda self, worker, data: published.append((worker, data))})())
+    monkeypatch.setattr(app, "remote_queues", {})
+    monkeypatch.setattr(app, "remote_frames", {})
+    app.commit_stroke("c1", server, "1", {"author": "teacher", "points": [{"x": 0.1, "y": 0.1}, {"x": 0.2, "y": 0.2}]})
+
+    async def envelope(header, body=b""):
+        app.on_backplane_message(app.encode(header) + b"\n" + body)
+        while app.remote_queues:
+            await asyncio.sleep(0)
+        # frames for the host go out on the next loop iteration
+        await asyncio.sleep(0)
+
+    async def run():
+        join = {"type": "join", "role": "teacher", "class_id": "c1", "key": "KEY123"}
+        await envelope({"op": "msg", "client": "r", "from": 1}, app.encode(join))
+        published.clear()
+        await envelope({"op": "resync", "client": "r"})
+    asyncio.run(run())
+    assert len(published) == 1
+    worker, data = published[0]
+    header, _, body = data.partition(b"\n")
+    assert worker == 1
+    assert app.decode(header) == {"op": "frame", "kind": "init_strokes", "clients": ["r"]}
+    assert [st["id"] for st in app.decode(body)["strokes"]["1"]] == [1]
+
+
+def test_websocket_does_not_negotiate_deflate(monkeypatch):
+    monkeypatch.setattr(app, "clients", {})
+
+    async def run():
+        server = web.Application()
+        server.router.add_get("/ws", app.websocket_handler)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                # as every browser does
+                ws = await session.ws_connect(f"http://127.0.0.1:{runner.addresses[0][1]}/ws", compress=15)
+                await ws.close()
+                return ws.compress
+        finally:
+            await runner.cleanup()
+    assert asyncio.run(run()) == 0
+
+
+@pytest.mark.parametrize("page", ["abc", 0, -3, 1.5, None, "٣"])
+def test_goto_page_rejects_bad_pages(server, page):
+    async def run():
+        await join_teacher()
+        sent = await send("t", {"type": "goto_page", "page": page})
+        assert sent[-1] == {"type": "error", "error": "bad-page"}
+        # a paged joiner still gets the page the teacher was on
+        connect("p")
+        sent = await send("p", {"type": "join", "role": "teacher", "class_id": "c1", "key": "KEY123", "features": ["paged"]})
+        return next(m for m in sent if m["type"] == "init_strokes")
+    assert asyncio.run(run())["page"] == "1"
+
+
+def test_goto_page(server):
+    async def run():
+        await join_teacher()
+        sent = await send("t", {"type": "goto_page", "page": "3"})
+        assert sent[-1] == {"type": "goto_page", "page": 3}
+    asyncio.run(run())
+    assert server["_current_page"] == "3"
+
+
+@pytest.mark.parametrize("page", ["abc", 0, -3])
+def test_request_annotate_rejects_bad_pages(server, page):
+    async def run():
+        await join_teacher()
+        sent = await join_student("s", "Ann")
+        await send("s", {"type": "request_annotate", "page": page})
+        assert sent[-1] == {"type": "error", "error": "bad-page"}
+        await send("s", {"type": "request_annotate", "page": 2})
+        assert sent[-1] == {"type": "info", "message": "request_created"}
+    asyncio.run(run())
+    assert [r["page"] for r in server["pending"].values()] == [2]
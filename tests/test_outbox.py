@@ -0,0 +1,166 @@
+"""The slow-consumer policy of deliver(): drop superseded frames, resync, and finally disconnect."""
+import asyncio
+
+import pytest
+
+import app
+
+
+class StuckSocket:
+    """A WebSocket whose peer never reads: every send waits forever."""
+
+    async def send_frame(self, data, kind):
+        await asyncio.Event().wait()
+
+    async def send_str(self, text):
+        await asyncio.Event().wait()
+
+
+class GatedSocket:
+    """A WebSocket whose peer reads only while the gate is open."""
+
+    def __init__(self):
+        self.gate = asyncio.Event()
+        self.sent = []
+
+    async def send_frame(self, data, kind):
+        await self.gate.wait()
+        self.sent.append(app.decode(data))
+
+
+class Transport:
+    aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+
+class RecordingBackplane:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, worker, data):
+        header, _, body = data.partition(b"\n")
+        self.published.append((worker, app.decode(header), body))
+
+
+@pytest.fixture
+def backplane(monkeypatch):
+    monkeypatch.setattr(app, "OUTBOX_MAX", 4)
+    monkeypatch.setattr(app, "SLOW_CLIENT_OVERFLOWS", 3)
+    monkeypatch.setattr(app, "clients", {})
+    monkeypatch.setattr(app, "metrics", dict(app.metrics, resyncs=0, slow_disconnects=0))
+    recorder = RecordingBackplane()
+    monkeypatch.setattr(app, "backplane", recorder)
+    return recorder
+
+
+def stroke_frame(i):
+    return app.Frame({"type": "apply_stroke", "stroke": {"id": i, "page": "1", "author": "teacher", "p": ""}})
+
+
+@pytest.fixture
+def local_client(backplane, monkeypatch):
+    """Returns a function connecting a client with the given socket to a class "c1" of this worker."""
+    room = app.hydrate_room({"teacher_key": "KEY123", "pdf_filename": "doc.pdf", "students": {}, "pending": {}})
+    monkeypatch.setattr(app, "classes", {"c1": room})
+    monkeypatch.setattr(app, "class_clients", {})
+
+    def connect(ws):
+        transport = Transport()
+        info = app.clients["c"] = app.new_client("c", ws, transport, app.Outbox(ws))
+        info.update(class_id="c1", room=room, role="teacher", token="teacher")
+        return info, transport
+    return connect
+
+
+def kinds(outbox):
+    return [frame.kind for frame in outbox.frames]
+
+
+def test_overflow_replaces_superseded_frames_with_a_resync(local_client):
+    async def run():
+        info, transport = local_client(StuckSocket())
+        out = info["outbox"]
+        # the writer takes the first frame and never finishes sending it
+        app.deliver(info, stroke_frame(0))
+        await asyncio.sleep(0)
+        app.deliver(info, stroke_frame(1))
+        app.deliver(info, app.Frame({"type": "info", "message": "hello"}))
+        app.deliver(info, stroke_frame(2))
+        app.deliver(info, stroke_frame(3))
+        assert kinds(out) == ["apply_stroke", "info", "apply_stroke", "apply_stroke"]
+        # full: the strokes give way to one snapshot, which already includes the new one
+        app.deliver(info, stroke_frame(4))
+        assert kinds(out) == ["info", "init_strokes"]
+        # the next overflow replaces that snapshot too; a frame no snapshot covers is still sent, after it
+        app.deliver(info, stroke_frame(5))
+        app.deliver(info, app.Frame({"type": "annotator_update"}))
+        app.deliver(info, app.Frame({"type": "info", "message": "bye"}))
+        assert kinds(out) == ["info", "annotator_update", "init_strokes", "info"]
+        assert (out.overflows, transport.aborted) == (2, False)
+    asyncio.run(run())
+    assert app.metrics["resyncs"] == 2 and app.metrics["slow_disconnects"] == 0
+
+
+def test_client_that_stays_behind_is_disconnected(local_client):
+    async def run():
+        info, transport = local_client(StuckSocket())
+        app.deliver(info, stroke_frame(0))
+        await asyncio.sleep(0)
+        while not transport.aborted:
+            app.deliver(info, stroke_frame(1))
+        return info["outbox"]
+    out = asyncio.run(run())
+    assert out.closed and not out.frames
+    assert app.metrics["resyncs"] == app.SLOW_CLIENT_OVERFLOWS
+    assert app.metrics["slow_disconnects"] == 1
+
+
+def test_nothing_to_drop_disconnects_at_once(local_client):
+    async def run():
+        info, transport = local_client(StuckSocket())
+        for _ in range(app.OUTBOX_MAX + 2):
+            app.deliver(info, app.Frame({"type": "info", "message": "hello"}))
+        return transport
+    assert asyncio.run(run()).aborted
+    assert app.metrics["resyncs"] == 0 and app.metrics["slow_disconnects"] == 1
+
+
+def test_overflows_are_forgiven_once_the_queue_drains(local_client):
+    async def run():
+        ws = GatedSocket()
+        info, transport = local_client(ws)
+        for _ in range(app.SLOW_CLIENT_OVERFLOWS + 2):
+            for i in range(app.OUTBOX_MAX + 2):
+                app.deliver(info, stroke_frame(i))
+            assert info["outbox"].overflows >= 1
+            ws.gate.set()
+            while info["outbox"].frames:
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            ws.gate.clear()
+            assert info["outbox"].overflows == 0
+        return ws, transport
+    ws, transport = asyncio.run(run())
+    assert not transport.aborted
+    assert [m["type"] for m in ws.sent].count("init_strokes") == app.SLOW_CLIENT_OVERFLOWS + 2
+
+
+def test_relayed_client_is_resynced_by_its_owner(backplane):
+    async def run():
+        ws, transport = StuckSocket(), Transport()
+        info = app.clients["c"] = app.new_client("c", ws, transport, app.Outbox(ws))
+        # joined a class that worker 1 owns; this worker only holds the socket
+        info["owner"] = 1
+        i = 0
+        while not transport.aborted:
+            app.deliver(info, stroke_frame(i))
+            i += 1
+        return info["outbox"]
+    out = asyncio.run(run())
+    resyncs = [header for worker, header, _ in backplane.published if worker == 1 and header["op"] == "resync"]
+    assert resyncs == [{"op": "resync", "client": "c"}] * app.SLOW_CLIENT_OVERFLOWS
+    assert app.metrics["resyncs"] == app.SLOW_CLIENT_OVERFLOWS
+    assert app.metrics["slow_disconnects"] == 1
+    assert out.closed
@@ -0,0 +1,196 @@
+"""Per-class snapshots and journals: replay, compaction and restarts."""
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+import app
+
+
+def new_room(class_id):
+    room = app.hydrate_room({"teacher_key": "KEY123", "pdf_filename": "doc.pdf", "students": {}, "pending": {},
+                             "last_student_annotator": None, "current_annotator": None})
+    app.classes[class_id] = room
+    app.journal_meta(class_id)
+    return room
+
+
+def stroke(author="teacher", n=5):
+    return {"author": author, "color": "#ff0000", "width": 3,
+            "points": [{"x": 0.1 + i * 0.01, "y": 0.2 + (i % 2) * 0.01} for i in range(n)]}
+
+
+def assert_same_points(packed, points):
+    unpacked = app.unpack_points(packed)
+    assert len(unpacked) == len(points)
+    for a, b in zip(points, unpacked):
+        assert abs(a["x"] - b["x"]) <= 1 / app.Q16_SCALE and abs(a["y"] - b["y"]) <= 1 / app.Q16_SCALE
+
+
+def journal_lines(records):
+    return b"".join(app.encode(r) + b"\n" for r in records)
+
+
+def test_journal_replay_skips_torn_last_line(state):
+    os.makedirs(state)
+    records = [{"op": "meta", "class_id": "c1", "meta": {"teacher_key": "KEY123", "pdf_filename": "doc.pdf"}},
+               {"op": "stroke", "class_id": "c1", "page": "1", "stroke": dict(stroke(), id=1)},
+               {"op": "stroke", "class_id": "c1", "page": "2", "stroke": dict(stroke(), id=2)}]
+    torn = app.encode({"op": "stroke", "class_id": "c1", "page": "1", "stroke": dict(stroke(), id=3)})[:-10]
+    with open(app.journal_path("c1"), "wb") as f:
+        f.write(journal_lines(records) + torn)
+    room = app.read_room("c1")
+    assert room["teacher_key"] == "KEY123"
+    assert {page: list(s) for page, s in room["strokes"].items()} == {"1": [1], "2": [2]}
+    assert room["seq"] == 2
+    assert room["next_stroke_id"] == 3
+    assert_same_points(room["strokes"]["1"][1]["p"], stroke()["points"])
+
+
+def test_journal_replays_clear_and_remove(state):
+    os.makedirs(state)
+    records = [{"op": "stroke", "class_id": "c1", "page": "1", "stroke": dict(stroke("teacher"), id=1)},
+               {"op": "stroke", "class_id": "c1", "page": "1", "stroke": dict(stroke("tok"), id=2)},
+               {"op": "stroke", "class_id": "c1", "page": "1", "stroke": dict(stroke("tok"), id=3)},
+               {"op": "remove", "class_id": "c1", "author": "tok", "ids": [2]},
+               {"op": "clear", "class_id": "c1", "author": "teacher"}]
+    with open(app.journal_path("c1"), "wb") as f:
+        f.write(journal_lines(records))
+    room = app.read_room("c1")
+    assert list(room["strokes"]["1"]) == [3]
+    assert room["seq"] == 5
+
+
+def test_compaction_writes_snapshot_and_truncates_journal(state, monkeypatch):
+    os.makedirs(state)
+    monkeypatch.setattr(app, "JOURNAL_COMPACT_RECORDS", 4)
+    room = new_room("c1")
+    for _ in range(2):
+        app.commit_stroke("c1", room, "1", stroke())
+    asyncio.run(app.flush_persistence())
+    # three records: below the threshold, so journal only
+    assert not os.path.exists(app.snapshot_path("c1"))
+    assert os.path.getsize(app.journal_path("c1")) > 0
+    app.commit_stroke("c1", room, "2", stroke())
+    asyncio.run(app.flush_persistence())
+    assert os.path.exists(app.snapshot_path("c1"))
+    assert os.path.getsize(app.journal_path("c1")) == 0
+    with open(app.snapshot_path("c1"), "rb") as f:
+        snapshot = json.loads(f.read())
+    assert snapshot["seq"] == 3
+    assert {page: len(lst) for page, lst in snapshot["strokes"].items()} == {"1": 2, "2": 1}
+    reloaded = app.read_room("c1")
+    assert app.stroke_pages(reloaded) == app.stroke_pages(room)
+
+
+def test_seq_and_ids_survive_restart(state):
+    os.makedirs(state)
+    room = new_room("c1")
+    first = app.commit_stroke("c1", room, "1", stroke())
+    app.commit_stroke("c1", room, "1", stroke("tok"))
+    app.remove_stroke(room, "teacher", first["id"])
+    app.journal_remove("c1", "teacher", [first["id"]])
+    asyncio.run(app.flush_persistence())
+    # from the journal alone
+    reloaded = app.read_room("c1")
+    assert (reloaded["seq"], reloaded["next_stroke_id"]) == (room["seq"], room["next_stroke_id"]) == (3, 3)
+    # and from a snapshot plus a journal written after it
+    asyncio.run(app.flush_persistence(compact=["c1"]))
+    app.commit_stroke("c1", room, "1", stroke())
+    asyncio.run(app.flush_persistence())
+    reloaded = app.read_room("c1")
+    assert (reloaded["seq"], reloaded["next_stroke_id"]) == (room["seq"], room["next_stroke_id"]) == (4, 4)
+    assert app.stroke_pages(reloaded) == app.stroke_pages(room)
+
+
+def test_eviction_compacts_only_idle_classes(state, monkeypatch):
+    os.makedirs(state)
+    monkeypatch.setattr(app, "ROOM_SWEEP_INTERVAL", 0)
+    monkeypatch.setattr(app, "ROOM_IDLE_TIMEOUT", 0)
+    monkeypatch.setattr(app, "class_clients", {"busy": {"someone": {}}})
+    for class_id in ("idle", "busy"):
+        room = new_room(class_id)
+        room["_last_active"] = 0
+        app.commit_stroke(class_id, room, "1", stroke())
+
+    async def sweep():
+        evictor = asyncio.ensure_future(app.evict_idle_rooms())
+        while "idle" in app.classes:
+            await asyncio.sleep(0.01)
+        evictor.cancel()
+    asyncio.run(asyncio.wait_for(sweep(), 5))
+    assert list(app.classes) == ["busy"]
+    assert os.path.exists(app.snapshot_path("idle")) and os.path.getsize(app.journal_path("idle")) == 0
+    # the busy class only had its journal appended
+    assert not os.path.exists(app.snapshot_path("busy")) and os.path.getsize(app.journal_path("busy")) > 0
+
+
+def test_legacy_state_is_split_per_class(state):
+    legacy = {"c1": {"teacher_key": "KEY123", "pdf_filename": "doc.pdf", "students": {"tok": {"name": "Ann", "allowed": True}},
+                     "pending": {}, "strokes": {"1": [stroke()]}},
+              "c2": {"teacher_key": "KEY456", "pdf_filename": "other.pdf", "students": {}, "pending": {}, "strokes": {}},
+              "bad/id": {"teacher_key": "X", "pdf_filename": "x.pdf", "strokes": {}}}
+    with open(app.LEGACY_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(legacy, f)
+    with open(app.LEGACY_JOURNAL_FILE, "wb") as f:
+        f.write(journal_lines([{"op": "stroke", "class_id": "c2", "page": "3", "stroke": stroke("tok")}]))
+    app.load_state()
+    assert sorted(os.listdir(state)) == ["c1.json", "c2.json"]
+    c1, c2 = app.read_room("c1"), app.read_room("c2")
+    assert c1["students"]["tok"]["name"] == "Ann"
+    assert_same_points(c1["strokes"]["1"][1]["p"], stroke()["points"])
+    assert list(c2["strokes"]["3"]) == [1]
+    assert c2["seq"] == 1
+    # done once: a second start leaves STATE_DIR alone
+    os.unlink(app.snapshot_path("c2"))
+    app.load_state()
+    assert sorted(os.listdir(state)) == ["c1.json"]
+
+
+def test_import_leaves_state_alone(tmp_path):
+    shutil.copy(app.__file__, tmp_path)
+    os.makedirs(tmp_path / "static")
+    with open(tmp_path / "state.json", "w", encoding="utf-8") as f:
+        json.dump({"c1": {"teacher_key": "KEY123", "pdf_filename": "doc.pdf", "strokes": {}}}, f)
+    subprocess.run([sys.executable, "-c", "import app"], cwd=tmp_path, check=True)
+    assert not os.path.exists(tmp_path / "state")
+
+
+def test_shutdown_keeps_changes_made_while_sockets_close(state, tmp_path, monkeypatch):
+    os.makedirs(state)
+    # the server shuts its persistence thread down; later tests need one
+    monkeypatch.setattr(app, "persist_executor", ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(app, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "PDF_REFS_DIR", str(tmp_path / "refs"))
+    for name in ("clients", "class_clients", "token_clients"):
+        monkeypatch.setattr(app, name, {})
+    new_room("c1")
+
+    async def run():
+        runner = web.AppRunner(app.app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        port = runner.addresses[0][1]
+        async with aiohttp.ClientSession() as session:
+            ws = await session.ws_connect(f"http://127.0.0.1:{port}/ws")
+            await ws.send_json({"type": "join", "role": "teacher", "class_id": "c1", "key": "KEY123"})
+            while (await ws.receive_json())["type"] != "joined":
+                pass
+            # mostly unread by the server when it starts shutting down
+            for _ in range(20):
+                await ws.send_json({"type": "stroke", "stroke": stroke()})
+            cleanup = asyncio.ensure_future(runner.cleanup())
+            async for _ in ws:
+                pass
+            await cleanup
+            return ws.close_code
+    assert asyncio.run(run()) == aiohttp.WSCloseCode.GOING_AWAY
+    # whatever the server applied before the socket closed is on disk; the rest was never taken in
+    applied = app.stroke_pages(app.classes["c1"])
+    assert applied and app.stroke_pages(app.read_room("c1")) == applied
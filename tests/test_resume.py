@@ -0,0 +1,28 @@
+"""Rejoining with last_seq: which buffered stroke changes a client missed."""
+from collections import deque
+
+import app
+
+
+def room_with_deltas(seq, first_buffered):
+    return {"seq": seq, "_deltas": deque({"type": "apply_stroke", "seq": s} for s in range(first_buffered, seq + 1))}
+
+
+def test_missed_deltas():
+    room = room_with_deltas(10, 6)
+    assert app.missed_deltas(room, 10) == []
+    assert [d["seq"] for d in app.missed_deltas(room, 7)] == [8, 9, 10]
+    # seq 6 is the oldest buffered change, so a client at 5 misses nothing
+    assert [d["seq"] for d in app.missed_deltas(room, 5)] == [6, 7, 8, 9, 10]
+    # a client at 4 missed seq 5, which is gone
+    assert app.missed_deltas(room, 4) is None
+    assert app.missed_deltas(room, 11) is None
+    assert app.missed_deltas(room, -1) is None
+    assert app.missed_deltas(room, "7") is None
+    assert app.missed_deltas(room, True) is None
+
+
+def test_missed_deltas_empty_buffer():
+    room = room_with_deltas(3, 4)
+    assert app.missed_deltas(room, 3) == []
+    assert app.missed_deltas(room, 2) is None
@@ -0,0 +1,157 @@
+"""Stroke encoding and the checks on incoming strokes."""
+import asyncio
+import math
+import random
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+import app
+
+
+class RecordingOutbox:
+    frames = ()
+
+    def __init__(self):
+        self.sent = []
+
+    def push(self, frame):
+        self.sent.append(app.decode(frame.data))
+        return True
+
+
+def test_pack_points_round_trip():
+    rng = random.Random(1)
+    # includes both ends of the range, so deltas wrap around int16
+    points = [{"x": 0.0, "y": 1.0}, {"x": 1.0, "y": 0.0}] + [{"x": rng.random(), "y": rng.random()} for _ in range(200)]
+    unpacked = app.unpack_points(app.pack_points(points))
+    assert len(unpacked) == len(points)
+    for a, b in zip(points, unpacked):
+        # half a quantization step, plus the rounding to 5 decimals
+        assert abs(a["x"] - b["x"]) <= 0.5 / app.Q16_SCALE + 5e-6
+        assert abs(a["y"] - b["y"]) <= 0.5 / app.Q16_SCALE + 5e-6
+
+
+def test_pack_points_empty_and_malformed():
+    assert app.unpack_points(app.pack_points([])) == []
+    with pytest.raises(ValueError):
+        app.unpack_points("not base64!")
+    with pytest.raises(ValueError):
+        # a varint whose continuation bit is set on its last byte
+        app.unpack_points("gA==")
+    with pytest.raises(ValueError):
+        # one value: an x without its y
+        app.unpack_points("AA==")
+
+
+def distance_to_segment(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    seg2 = dx * dx + dy * dy
+    t = 0.0 if seg2 == 0 else min(1.0, max(0.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / seg2))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+@pytest.mark.parametrize("n", [3, 24, 400, 1000])
+def test_simplify_points_stays_within_tolerance(monkeypatch, use_numpy, n):
+    if use_numpy and app.numpy is None:
+        pytest.skip("numpy is not installed")
+    if not use_numpy:
+        monkeypatch.setattr(app, "numpy", None)
+    rng = random.Random(n)
+    points = [{"x": 0.5 + 0.3 * math.sin(i / 20) + rng.uniform(-0.002, 0.002), "y": 0.5 + 0.3 * math.cos(i / 31)}
+              for i in range(n)]
+    tolerance = 0.001
+    kept = app.simplify_points(points, tolerance)
+    assert kept[0] is points[0] and kept[-1] is points[-1]
+    assert len(kept) <= len(points)
+    # simplification works on quantized coordinates, so allow one quantization step more
+    quantized = lambda p: (app.quantize(p["x"]) / app.Q16_SCALE, app.quantize(p["y"]) / app.Q16_SCALE)
+    line = [quantized(p) for p in kept]
+    for p in points:
+        assert min(distance_to_segment(quantized(p), a, b) for a, b in zip(line, line[1:])) <= tolerance + 1 / app.Q16_SCALE
+
+
+def test_simplify_points_drops_collinear_points():
+    points = [{"x": i / 100, "y": 0.5} for i in range(101)]
+    assert app.simplify_points(points, 0.0005) == [points[0], points[-1]]
+
+
+def test_token_bucket(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+    bucket = app.TokenBucket(10, 20)
+    assert bucket.take(20)
+    assert not bucket.take()
+    now[0] += 0.5
+    assert bucket.take(5)
+    assert not bucket.take()
+    # refills up to the burst, no further
+    now[0] += 100
+    assert not bucket.take(21)
+    assert bucket.take(20)
+
+
+@pytest.fixture
+def sender(monkeypatch):
+    monkeypatch.setattr(app, "MAX_STROKE_POINTS", 10)
+    monkeypatch.setattr(app, "metrics", dict(app.metrics, strokes_too_large=0, rate_limited=0))
+    me = app.new_client("c", None, None, RecordingOutbox())
+    me["point_bucket"] = app.TokenBucket(1, 25)
+    return me
+
+
+def points(n):
+    return [{"x": i / 100, "y": 0.5} for i in range(n)]
+
+
+def test_take_points_caps_stroke_size(sender):
+    assert app.take_points(sender, {"points": points(10)}) == points(10)
+    assert app.take_points(sender, {"points": points(11)}) is None
+    # a streamed stroke counts the points it already has
+    assert app.take_points(sender, {"points": points(3)}, held=8) is None
+    assert app.take_points(sender, {"p": app.pack_points(points(2))}, held=8) == app.unpack_points(app.pack_points(points(2)))
+    # too long to hold few enough points, so turned away without being decoded
+    assert app.take_points(sender, {"p": "!" * 81}) is None
+    assert sender["outbox"].sent == [{"type": "error", "error": "stroke-too-large"}] * 3
+    assert app.metrics["strokes_too_large"] == 3
+
+
+def test_take_points_rate_limits_points(sender):
+    assert app.take_points(sender, {"points": points(10)}) is not None
+    assert app.take_points(sender, {"points": points(10)}) is not None
+    assert app.take_points(sender, {"points": points(10)}) is None
+    assert app.take_points(sender, {"points": points(5)}) is not None
+    assert sender["outbox"].sent == [{"type": "error", "error": "rate-limited"}]
+    assert app.metrics["rate_limited"] == 1
+
+
+def test_messages_over_the_rate_are_dropped(monkeypatch):
+    monkeypatch.setattr(app, "MSG_RATE", 0.001)
+    monkeypatch.setattr(app, "RATE_BURST", 3000)
+    monkeypatch.setattr(app, "clients", {})
+
+    async def run():
+        server = web.Application()
+        server.router.add_get("/ws", app.websocket_handler)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", 0).start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                ws = await session.ws_connect(f"http://127.0.0.1:{runner.addresses[0][1]}/ws")
+                for _ in range(7):
+                    await ws.send_json({"type": "nonsense"})
+                replies = []
+                try:
+                    while True:
+                        replies.append(await ws.receive_json(timeout=0.3))
+                except asyncio.TimeoutError:
+                    pass
+                await ws.close()
+                return replies
+        finally:
+            await runner.cleanup()
+    # told once per run of dropped messages, however long
+    assert [r["error"] for r in asyncio.run(run())] == ["unknown-type"] * 3 + ["rate-limited"]